@@ -0,0 +1,134 @@
+"""
+A small asyncio HTTP/1.1 server, just enough to serve `rest2passthrough`'s
+routes without Werkzeug's development server.
+
+One event loop owns every connection (kept alive between requests, as
+`requests.Session` expects), and handlers -- which block on backends -- run
+on a fixed pool of worker threads, so hundreds of idle or slow FUSE clients
+cost a coroutine each rather than a thread each.
+"""
+
+import asyncio
+import concurrent.futures
+import http
+import urllib.parse
+
+
+DEFAULT_WORKERS = 16
+MAX_HEADER_BYTES = 2**16
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = http.HTTPStatus(status)
+
+
+class Request:
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    @property
+    def form(self):
+        return {key: values[0] for (key, values) in urllib.parse.parse_qs(self.body.decode("latin-1")).items()}
+
+
+async def read_request(reader):
+    """
+    Return the next `Request` on the connection, or None once the client hangs up.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise HTTPError(400)
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(431)
+
+    (request_line, *header_lines) = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+    try:
+        (method, target, version) = request_line.split(" ")
+    except ValueError:
+        raise HTTPError(400)
+
+    headers = {}
+    for line in header_lines:
+        (name, _, value) = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411)  # NOTE(mcotton): Neither `requests` nor FUSE clients send chunked bodies.
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+
+    path = urllib.parse.urlsplit(target).path
+    return Request(method, path, headers, body)
+
+
+def response_head(status, content_type, length, keep_alive, headers=None):
+    status = http.HTTPStatus(status)
+    return (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {length}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        + "".join(f"{name}: {value}\r\n" for (name, value) in (headers or {}).items())
+        + "\r\n"
+    ).encode("latin-1")
+
+
+class Server:
+    """
+    Serves `handler(request) -> (status, content_type, body, headers)` over HTTP.
+
+    The handler runs on one of `workers` threads; requests beyond that queue
+    up (on the loop, not in threads) until a worker frees up.
+    """
+    def __init__(self, handler, workers=DEFAULT_WORKERS):
+        self.handler = handler
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aio-worker")
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    writer.write(response_head(e.status, "text/plain", 0, keep_alive=False))
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                try:
+                    (status, content_type, body, headers) = await loop.run_in_executor(self.executor, self.handler, request)
+                except HTTPError as e:
+                    (status, content_type, body, headers) = (e.status, "text/plain", b"", {})
+                except Exception as e:
+                    print(f"[!] Handler failed for {request.method} {request.path}: {repr(e)}")
+                    (status, content_type, body, headers) = (500, "text/plain", b"", {})
+
+                writer.write(response_head(status, content_type, len(body), keep_alive, headers))
+                writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        print(f"Serving http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host, port):
+        asyncio.run(self.serve(host, port))
@@ -35,6 +35,16 @@ class AbstractReadOnlyBackend(abc.ABC):
         """
         raise NotImplementedError()
 
+    def read_chunks(self, path: str, length: int, offset: int):
+        """
+        Like `read`, but return an iterator of byte chunks (e.g. memoryviews),
+        produced as the data becomes available.
+
+        Errors about the path itself should be raised by this call, not by
+        the iterator.
+        """
+        return iter([self.read(path, length, offset)])
+
     def size(path: str) -> int:
         """
         Return the size of the file or directory at the given path.
@@ -44,3 +54,10 @@ class AbstractReadOnlyBackend(abc.ABC):
         If the path does not exist, raise `errno.ENOENT` (2).
         """
         raise NotImplementedError()
+
+    def release(self, path: str) -> None:
+        """
+        Called once the last open handle on a file is closed, so the backend
+        can stop prefetching it.  Optional.
+        """
+        pass
@@ -4,13 +4,14 @@ import json
 import logging
 import os
 import pathlib
+import posixpath
 import sys
 
 sys.path.append(os.environ.get("MMSRC", ""))
 from mediaman.core import policy
 
 from FUSE.backends.abstract import AbstractReadOnlyBackend
-from FUSE.caches import block_cache
+from FUSE.caches import block_cache, prefetch
 from FUSE.errors import deny, notreal
 
 
@@ -18,103 +19,147 @@ from FUSE.errors import deny, notreal
 logging.getLogger("mattccs.mediaman").setLevel(logging.INFO)
 
 
+class Node:
+    """
+    One path of a compiled filesystem image.  `children` is None for files,
+    and `size` is 0 for folders.
+    """
+    __slots__ = ("size", "hash", "children")
+
+    def __init__(self, size=0, hash=None, children=None):
+        self.size = size
+        self.hash = hash
+        self.children = children  # Names, in image order.
+
+
 class ReadOnlyPredefinedMMBackend(AbstractReadOnlyBackend):
-    def __init__(self, filesystem_image=None, filesystem_image_mm_hash="xxh64:28958e05597643fb", service_selector=None):
+    def __init__(self, filesystem_image=None, filesystem_image_mm_hash="xxh64:28958e05597643fb", service_selector=None, disk_cache=None, blocksize=block_cache.DEFAULT_IOSIZE):
         self._service_selector = service_selector
+        self._disk_cache = disk_cache
+        self._blocksize = blocksize
+        self._stats = block_cache.stats_for(type(self).__name__)
         self._service = policy.load_client(service_selector=self._service_selector)
 
         if filesystem_image:
-            self._filesystem = json.loads(filesystem_image)
+            filesystem = json.loads(filesystem_image)
         else:
             result = self._service.stream(
                 root=pathlib.Path(),
                 identifier=filesystem_image_mm_hash,
             )
-            self._filesystem = json.loads(list(result)[0])
+            filesystem = json.loads(list(result)[0])
+        self._nodes = ReadOnlyPredefinedMMBackend._compile(filesystem)  # path -> Node
         self._caches = {}  # hash -> func()
 
-        logging.info("ready")
-
-    @staticmethod
-    def _path_to_keys(path):
-        if path == "/":
-            return []
-        return path.lstrip("/").split("/")
+        logging.info(f"ready: {len(self._nodes)} paths")
 
     @staticmethod
     def _is_dir(obj):
         return isinstance(obj, dict) and obj.get("file", False) is False
 
-    def _access(self, path):
-        keys = ReadOnlyPredefinedMMBackend._path_to_keys(path)
-        logging.debug(f"_access ({path=}) - {keys=}")
-        d = self._filesystem
-        try:
-            for k in keys:
-                d = d[k]
-        except KeyError:
-            return None
-        return d
+    @staticmethod
+    def _compile(filesystem):
+        """
+        Flatten the nested image into `{path: Node}`, once, so every lookup
+        after is a single dict lookup instead of a walk from the root.
+        """
+        nodes = {}
+        pending = [("/", filesystem)]
+        while pending:
+            (path, obj) = pending.pop()
+            if ReadOnlyPredefinedMMBackend._is_dir(obj):
+                names = [name for (name, child) in obj.items() if isinstance(child, dict)]
+                nodes[path] = Node(children=tuple(names))  # TODO(mcotton): what should dir size be?
+                pending.extend((posixpath.join(path, name), obj[name]) for name in names)
+            else:
+                nodes[path] = Node(size=obj["size"], hash=obj["hash"])
+        return nodes
+
+    def _node(self, path):
+        logging.debug(f"_node ({path=})")
+        return self._nodes.get(path)
 
     def has(self, path):
         logging.debug(f"has ({path})")
-        return self._access(path) is not None
+        return path in self._nodes
 
     def is_dir(self, path):
         logging.debug(f"is_dir ({path})")
-        return ReadOnlyPredefinedMMBackend._is_dir(self._access(path))
+        node = self._node(path)
+        return node is not None and node.children is not None
 
     def list(self, path):
         logging.debug(f"list ({path})")
-        obj = self._access(path)
-        if obj is None:
+        node = self._node(path)
+        if node is None or node.children is None:
             deny()
-        return list(obj.keys())
+        return list(node.children)
 
     def size(self, path):
         logging.debug(f"size ({path})")
-        obj = self._access(path)
-        if obj is None:
+        node = self._node(path)
+        if node is None:
             notreal()
-        elif self._is_dir(obj):
-            return 0  # TODO(mcotton): what should dir size be?
-        return obj["size"]
+        return node.size
 
     def read(self, path, length, offset):
         logging.debug(f"read ({path=}, {length=}, {offset=})")
-        obj = self._access(path)
-        if obj is None:
+        return self._buffer(path).read(length=length, offset=offset)
+
+    def read_chunks(self, path, length, offset):
+        logging.debug(f"read_chunks ({path=}, {length=}, {offset=})")
+        return self._buffer(path).read_chunks(length=length, offset=offset)
+
+    def _buffer(self, path):
+        node = self._node(path)
+        if node is None:
             notreal()
-        elif self._is_dir(obj):
+        elif node.children is not None:
             deny()
-        hash = obj["hash"]
+        hash = node.hash
 
         if hash not in self._caches:
             self._caches[hash] = block_cache.BlockwiseBuffer(
-                size=obj["size"],
+                size=node.size,
                 source=functools.partial(self._read, hash),
+                stream=functools.partial(self._stream, hash),
+                key=hash,
+                pool=block_cache.SHARED_POOL,
+                lower=self._disk_cache,
+                stats=self._stats,
+                blocksize=self._blocksize,
             )
-        buffer = self._caches[hash]
+        return self._caches[hash]
 
-        return buffer.read(length=length, offset=offset)
+    def release(self, path):
+        node = self._node(path)
+        if node is not None and node.hash in self._caches:
+            self._caches[node.hash].close()
 
     def _read(self, hash, length, offset):
         logging.debug(f"_read ({hash}, {length}, {offset})")
+        return b"".join(self._stream(hash, length=length, offset=offset))
+
+    def _stream(self, hash, length, offset):
+        logging.debug(f"_stream ({hash}, {length}, {offset})")
         try:
-            return b"".join(self._service.stream_range(
+            yield from self._service.stream_range(
                 root=pathlib.Path(),
                 identifier=hash,
                 offset=offset,
                 length=length,
-            ))
+            )
         except TypeError:
             raise notreal()
 
 
 class ReadOnlyFlatMMBackend(AbstractReadOnlyBackend):
-    def __init__(self, service_selector="local"):
+    def __init__(self, service_selector="local", disk_cache=None, blocksize=block_cache.DEFAULT_IOSIZE):
         # service_selector = "sam"
         self._service_selector = service_selector
+        self._disk_cache = disk_cache
+        self._blocksize = blocksize
+        self._stats = block_cache.stats_for(type(self).__name__)
         logging.debug(f"{service_selector=}")
         self._service = policy.load_client(service_selector=None)
 
@@ -125,6 +170,8 @@ class ReadOnlyFlatMMBackend(AbstractReadOnlyBackend):
         self._list_result = list(self._service.fuzzy_search_by_name(""))[0][1]
         # self._list_result = list(self._service.list_files())
 
+        self._limiter = prefetch.BackendLimiter(1)  # NOTE(mcotton): Drive can't multithread
+
         self._files = {
             f["name"] : {
                 "size": f["size"],
@@ -132,7 +179,14 @@ class ReadOnlyFlatMMBackend(AbstractReadOnlyBackend):
                 "buffer": block_cache.BlockwiseBuffer(
                     size=f["size"],
                     source=functools.partial(self._read, f["hashes"][0]),
-                    prefetch_blocks=2,  # TODO(mcotton): Drive can't multithread
+                    stream=functools.partial(self._stream, f["hashes"][0]),
+                    key=f["hashes"][0],
+                    pool=block_cache.SHARED_POOL,
+                    lower=self._disk_cache,
+                    limiter=self._limiter,
+                    stats=self._stats,
+                    blocksize=self._blocksize,
+                    prefetch_blocks=2,
                 )
             }
             for f in self._list_result
@@ -167,14 +221,30 @@ class ReadOnlyFlatMMBackend(AbstractReadOnlyBackend):
             return ref.read(offset=offset, length=length)
         notreal()
 
+    def read_chunks(self, path, length, offset):
+        path = path.lstrip("/")
+        if path in self._files:
+            ref = self._files[path]["buffer"]
+            return ref.read_chunks(offset=offset, length=length)
+        notreal()
+
+    def release(self, path):
+        path = path.lstrip("/")
+        if path in self._files:
+            self._files[path]["buffer"].close()
+
     def _read(self, hash, length, offset):
         logging.debug(f"_read ({hash}, {length}, {offset})")
-        return b"".join(self._service.stream_range(
+        return b"".join(self._stream(hash, length=length, offset=offset))
+
+    def _stream(self, hash, length, offset):
+        logging.debug(f"_stream ({hash}, {length}, {offset})")
+        return self._service.stream_range(
             root=pathlib.Path(),
             identifier=hash,
             offset=offset,
             length=length,
-        ))
+        )
 
 
 def test():
@@ -1,81 +1,184 @@
 
+import collections
 import errno
 import functools
 import os
 import pathlib
+import posixpath
+import threading
 
 from FUSE.backends.abstract import AbstractReadOnlyBackend
-from FUSE.caches import block_cache
+from FUSE.caches import block_cache, fd_pool, mapped_file
 from FUSE.errors import notreal
 
 
+DEFAULT_BLOCKSIZE = block_cache.DEFAULT_IOSIZE // 4  # Local reads are cheap, so keep blocks small.
+
+
 class ReadOnlyOSBackend(AbstractReadOnlyBackend):
-    def __init__(self, root):
+    """
+    Serves a local folder, indexed lazily: each directory is scanned (with
+    `os.scandir`) the first time something under it is looked up, sizes are
+    `stat`ed when first asked for, and buffers made on first read.  So
+    startup is instant however big the tree is.  `warm=True` also crawls the
+    whole tree in the background.
+
+    With `mmap=True`, files are memory-mapped instead of read through the
+    block cache, and reads return memoryviews of the mapping.
+    """
+    def __init__(self, root, blocksize=DEFAULT_BLOCKSIZE, warm=False, max_fds=fd_pool.DEFAULT_MAX_FDS, mmap=False):
         self._root = pathlib.Path(root)
-        self._files = {}
+        self._blocksize = blocksize
+        self._mmap = mmap
+        self._stats = block_cache.stats_for(type(self).__name__)
+        self._fds = fd_pool.FilePool(max_fds)
+        self._files = {}  # path -> {"type", "size", "buffer", "symlink"}, for every entry of a scanned directory
+        self._children = {}  # directory -> names of its entries, once scanned
+        self._lock = threading.RLock()
 
         if not self._root.exists():
             print(self._root.absolute())
             raise RuntimeError(f"Root path ({root}) is not real!")
 
-        for p in self._root.glob("**/*"):
-            if not (p.is_file() or p.is_dir()):
-                continue
-
-            path = "/" + str(p.relative_to(self._root))
-            realpath = str(p)
-            type = "file" if p.is_file() else "dir"
-            size = p.stat().st_size
-            self._files[path] = {
-                "type": type,
-                "size": size,
-                "buffer": block_cache.BlockwiseBuffer(
-                    size=size,
-                    source=functools.partial(self._read, realpath)
-                )
-            }
+        if warm:
+            threading.Thread(target=self.crawl, name=f"crawl {self._root}", daemon=True).start()
 
-        # print(self._files.keys())
         print(f"ready: ReadOnlyOSBackend({self._root})")
 
+    def _realpath(self, path):
+        return os.path.join(self._root, path.lstrip("/"))
+
+    def _scan(self, path):
+        """
+        Index the entries of directory `path`, if not done already.  Returns
+        their names.
+        """
+        with self._lock:
+            if path in self._children:
+                return self._children[path]
+            names = []
+            try:
+                entries = list(os.scandir(self._realpath(path)))
+            except OSError as e:
+                print(f"[!] Couldn't scan {path}: {repr(e)}")
+                entries = []
+            for entry in entries:
+                # NOTE(mcotton): `DirEntry.is_*` use the type `readdir` already returned, so there's no `stat` per entry.
+                if entry.is_dir():
+                    kind = "dir"
+                elif entry.is_file():
+                    kind = "file"
+                else:
+                    continue
+                self._files[posixpath.join(path, entry.name)] = {
+                    "type": kind,
+                    "size": None,  # `stat`ed on demand.
+                    "buffer": None,  # Made on first read.
+                    "symlink": entry.is_symlink(),
+                }
+                names.append(entry.name)
+            self._children[path] = names
+            return names
+
+    def _lookup(self, path):
+        """
+        Return the index entry for `path`, scanning its ancestors as needed,
+        or None if it doesn't exist.
+        """
+        if path in self._files:
+            return self._files[path]
+        parent = posixpath.dirname(path)
+        if parent != "/":
+            ref = self._lookup(parent)
+            if ref is None or ref["type"] != "dir":
+                return None
+        self._scan(parent)
+        return self._files.get(path)
+
+    def _buffer(self, path):
+        ref = self._lookup(path)
+        if ref is None:
+            notreal()
+        with self._lock:
+            if ref["buffer"] is None and self._mmap:
+                ref["buffer"] = mapped_file.MappedFile(self._realpath(path), blocksize=self._blocksize)
+            elif ref["buffer"] is None:
+                realpath = self._realpath(path)
+                ref["buffer"] = block_cache.BlockwiseBuffer(
+                    size=self._size(path, ref),
+                    source=functools.partial(self._read, realpath),
+                    key=realpath,
+                    pool=block_cache.SHARED_POOL,
+                    stats=self._stats,
+                    blocksize=self._blocksize,
+                )
+            return ref["buffer"]
+
+    def _size(self, path, ref):
+        if ref["size"] is None:
+            ref["size"] = os.stat(self._realpath(path)).st_size
+        return ref["size"]
+
+    def crawl(self):
+        """
+        Scan every directory, breadth first, so later lookups never wait on
+        a scan.  Symlinked directories are left for lookups, in case of cycles.
+        """
+        pending = collections.deque(["/"])
+        while pending:
+            path = pending.popleft()
+            for name in self._scan(path):
+                child = posixpath.join(path, name)
+                ref = self._files[child]
+                if ref["type"] == "dir" and not ref["symlink"]:
+                    pending.append(child)
+        print(f"[i] Crawled {len(self._files)} entries under {self._root}")
+
     def has(self, path):
         print(f"has {(path)}")
-        out = path == "/" or path in self._files
+        out = path == "/" or self._lookup(path) is not None
         print(out); return out
 
     def is_dir(self, path):
         print(f"is_dir {(path)}")
-        out = path == "/" or self._files[path]["type"] == "dir"
+        out = path == "/" or self._lookup(path)["type"] == "dir"
         print(out); return out
 
     def list(self, path):
         print(f"list {(path)}")
-        out = [
-            str(pathlib.Path(p).relative_to(path)).strip("/")
-            for p in self._files
-            if pathlib.PurePath(p).match(
-                (path + "/*") if path.lstrip("/") else "/*"
-            )
-        ]
+        out = list(self._scan(path))
         print(out); return out
 
     def size(self, path):
         print(f"size {(path)}")
         # path = path.lstrip("/")
-        if path in self._files:
-            out = self._files[path]["size"]
+        ref = self._lookup(path)
+        if ref is not None:
+            out = self._size(path, ref)
             print(out); return out
         notreal()
 
     def read(self, path, length, offset):
         print(f"read {(path, length, offset)}")
         # path = path.lstrip("/")
-        if path in self._files:
-            ref = self._files[path]["buffer"]
-            return ref.read(offset=offset, length=length)
-        notreal()
+        return self._buffer(path).read(offset=offset, length=length)
+
+    def read_chunks(self, path, length, offset):
+        print(f"read_chunks {(path, length, offset)}")
+        return self._buffer(path).read_chunks(offset=offset, length=length)
+
+    def release(self, path):
+        print(f"release {(path)}")
+        ref = self._files.get(path)
+        if ref is None:
+            return
+        # NOTE(mcotton): Under the lock `_buffer` hands buffers out with, so nobody gets a mapping that's about to go.
+        with self._lock:
+            if ref["buffer"] is None:
+                return
+            ref["buffer"].close()
+            if self._mmap:
+                ref["buffer"] = None  # Unmapped; mapped again if reopened.
 
     def _read(self, path, length, offset):
-        with open(path, "r+b") as infile:
-            infile.seek(offset)
-            return infile.read(length)
+        return self._fds.pread(path, length, offset)
@@ -0,0 +1,83 @@
+"""
+Counts how many reads straddle two (or more) cache blocks, for a few block
+sizes and read patterns.  A straddling read costs a second block lookup, and
+on a miss, a second (or larger) fetch.
+
+Optionally replays a read log in the format `plot.py` takes.
+"""
+
+import argparse
+import json
+import random
+
+from FUSE.caches import block_cache
+
+
+FILE_SIZE = 10_602_424  # 01 One More Time.m4a
+KERNEL_READAHEAD = 2**17  # 128 KiB
+PAGE = 2**12
+
+BLOCKSIZES = (2_000_000, 2**20, 2**21, 2**22)
+
+
+def sequential(size, iosize):
+    return [(offset, min(iosize, size - offset)) for offset in range(0, size, iosize)]
+
+
+def music_app(size, rng):
+    """
+    Rapid, tiny, unaligned sequential reads.
+    """
+    reads = []
+    offset = 0
+    while offset < size:
+        length = min(rng.randrange(PAGE, 16 * PAGE), size - offset)
+        reads.append((offset, length))
+        offset += length
+    return reads
+
+
+def random_pages(size, rng, count=2_000):
+    return [(rng.randrange(0, size // PAGE) * PAGE, PAGE) for _ in range(count)]
+
+
+def from_logfile(filename):
+    with open(filename) as infile:
+        return [(event["offset"], event["length"]) for event in map(json.loads, infile)]
+
+
+def straddles(reads, blocksize):
+    touched = [((offset + length - 1) // blocksize) - (offset // blocksize) + 1 for (offset, length) in reads if length > 0]
+    return (sum(1 for n in touched if n > 1), sum(touched))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("logfile", nargs="?", default=None, help="Optional read log (as taken by `plot.py`) to replay")
+    parser.add_argument("--iosize", default=block_cache.DEFAULT_IOSIZE, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(0)
+
+    patterns = {
+        f"sequential iosize ({args.iosize})": sequential(FILE_SIZE, args.iosize),
+        f"kernel readahead ({KERNEL_READAHEAD})": sequential(FILE_SIZE, KERNEL_READAHEAD),
+        "Music.app (tiny sequential)": music_app(FILE_SIZE, rng),
+        "random pages": random_pages(FILE_SIZE, rng),
+    }
+    if args.logfile:
+        patterns[args.logfile] = from_logfile(args.logfile)
+
+    for (name, reads) in patterns.items():
+        print(f"{name}: {len(reads)} reads")
+        for blocksize in BLOCKSIZES:
+            (straddling, touched) = straddles(reads, blocksize)
+            aligned = " (aligned)" if blocksize == block_cache.aligned_blocksize(blocksize) else ""
+            print(f"    blocksize {blocksize:>9}{aligned:<10} {straddling:>5} straddling ({straddling / len(reads):6.1%}), {touched / len(reads):.2f} blocks/read")
+
+
+if __name__ == '__main__':
+    main()
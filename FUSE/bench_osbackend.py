@@ -0,0 +1,82 @@
+"""
+Times `ReadOnlyOSBackend` metadata calls on a big tree: startup, listing
+each directory (first and again), and looking up every file.
+
+Builds a tree of empty-ish files (`--files`, `--per-dir` to a folder) in a
+temporary directory, unless given an existing root.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from FUSE.backends import osbackend
+
+
+def build_tree(root, files, per_dir):
+    dirs = []
+    for n in range(files):
+        if n % per_dir == 0:
+            dirs.append(os.path.join(root, f"artist{len(dirs) // 10}", f"album{len(dirs) % 10}"))
+            os.makedirs(dirs[-1])
+        with open(os.path.join(dirs[-1], f"track{n % per_dir:05d}.m4a"), "wb") as outfile:
+            outfile.write(b"x" * (n % 7))
+
+
+def timed(func):
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # NOTE(mcotton): The backend prints every call.
+        out = func()
+    return (time.perf_counter() - t0, out)
+
+
+def folders(backend, path="/"):
+    yield path
+    for name in backend.list(path):
+        child = os.path.join(path, name)
+        if backend.is_dir(child):
+            yield from folders(backend, child)
+
+
+def bench(root):
+    (dt, backend) = timed(lambda: osbackend.ReadOnlyOSBackend(root))
+    print(f"    startup            {dt * 1000:9.1f}ms")
+
+    (dt, paths) = timed(lambda: list(folders(backend)))
+    print(f"    first walk         {dt * 1000:9.1f}ms  ({len(paths)} folders, scanning)")
+
+    (dt, listings) = timed(lambda: [backend.list(path) for path in paths])
+    entries = sum(map(len, listings))
+    print(f"    list every folder  {dt * 1000:9.1f}ms  ({entries} entries, {dt / len(paths) * 1e6:.0f}us/folder)")
+
+    files = [os.path.join(path, name) for (path, names) in zip(paths, listings) for name in names]
+    (dt, _) = timed(lambda: [backend.size(path) for path in files if not backend.is_dir(path)])
+    print(f"    size every file    {dt * 1000:9.1f}ms  ({dt / len(files) * 1e6:.1f}us/entry)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", nargs="?", default=None, help="Existing folder to index, instead of a generated tree")
+    parser.add_argument("--files", default=100_000, type=int)
+    parser.add_argument("--per-dir", default=1_000, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.root:
+        print(args.root)
+        bench(args.root)
+        return
+
+    with tempfile.TemporaryDirectory() as root:
+        build_tree(root, args.files, args.per_dir)
+        print(f"{args.files} files, {args.per_dir} per folder")
+        bench(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Load-tests a running `rest2passthrough` HTTP server: many concurrent clients,
+each on its own keep-alive session (as `fuse2rest` is), issuing a mix of
+`getattr`s and small `read`s.  Reports requests/sec and latency percentiles.
+
+Run it once against `--server flask` and once against `--server asyncio`.
+"""
+
+import argparse
+import base64
+import random
+import statistics
+import threading
+import time
+
+import msgpack
+import requests
+
+
+READ_LENGTH = 2**17  # 128 KiB, the kernel's default readahead.
+
+
+def pack_q(funcname, args, kwargs, procname):
+    # NOTE(mcotton): Same as `fuse2rest.pack_q`, which we can't import without libfuse.
+    bytez = msgpack.packb({"funcname": funcname, "args": args, "kwargs": kwargs, "proc": procname})
+    return base64.urlsafe_b64encode(bytez).decode("utf-8")
+
+
+def client(url, path, size, procname, read_ratio, deadline, latencies, errors, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    while time.perf_counter() < deadline:
+        if rng.random() < read_ratio:
+            (funcname, args) = ("read", [path, READ_LENGTH, rng.randrange(0, max(size - READ_LENGTH, 1)), 0])
+        else:
+            (funcname, args) = ("getattr", [path])
+        t0 = time.perf_counter()
+        try:
+            response = session.post(f"{url}/{funcname}", data={"q": pack_q(funcname, args, {}, procname)})
+            out = msgpack.unpackb(response.content)
+        except requests.RequestException:
+            errors.append(funcname)
+            continue
+        latencies[funcname].append(time.perf_counter() - t0)
+        if out["error"]:
+            errors.append(funcname)
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1] if len(values) > 1 else values[0]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="http://host:port of a running rest2passthrough")
+    parser.add_argument("path", help="A file to `getattr` and `read`, as the FUSE mount would name it")
+    parser.add_argument("--clients", default=64, type=int)
+    parser.add_argument("--seconds", default=10.0, type=float)
+    parser.add_argument("--read-ratio", default=0.5, type=float, help="Fraction of calls that are reads")
+    parser.add_argument("--procname", default="head", help="Process name to send (must be allowed by the server)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    url = args.url.rstrip("/")
+
+    attrs = msgpack.unpackb(requests.post(f"{url}/getattr", data={"q": pack_q("getattr", [args.path], {}, args.procname)}).content)
+    if attrs["error"]:
+        raise SystemExit(f"getattr {args.path} failed: errno {attrs['error']}")
+    size = attrs["result"]["st_size"]
+
+    latencies = {"getattr": [], "read": []}
+    errors = []
+    deadline = time.perf_counter() + args.seconds
+    threads = [
+        threading.Thread(target=client, args=(url, args.path, size, args.procname, args.read_ratio, deadline, latencies, errors, i))
+        for i in range(args.clients)
+    ]
+    t0 = time.perf_counter()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = time.perf_counter() - t0
+
+    total = sum(map(len, latencies.values()))
+    print(f"{args.clients} clients, {elapsed:.1f}s: {total / elapsed:.0f} req/s, {len(errors)} errors")
+    for (funcname, values) in latencies.items():
+        if not values:
+            continue
+        values = [v * 1000 for v in values]
+        print(f"    {funcname:<8} {len(values) / elapsed:7.0f} req/s   p50 {percentile(values, 50):7.2f}ms   p99 {percentile(values, 99):7.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 
 import abc
+import bisect
+import collections
+import contextlib
 import threading
 import time
 
+from FUSE.caches import prefetch
+
 
 class RangeReadable(abc.ABC):
     @abc.abstractmethod
@@ -23,38 +28,428 @@ class AbstractBuffer(RangeReadable):
         return self.start_absolute + len(self.buffer)
 
 
-def start_background_load(buffer, offset, length, block, blocks, delay_seconds=0):
-    t = threading.Thread(target=background_load, args=(buffer, offset, length, block, blocks, delay_seconds))
-    t.start()
-
+DEFAULT_IOSIZE = 2**22  # The `iosize` our FUSE mounts use (see `fuse2rest.py`).
+
+
+def aligned_blocksize(blocksize):
+    """
+    Round a block size up to a power of two (at least a 4 KiB page), so
+    blocks line up with the kernel's readahead and FUSE's `iosize` reads
+    rather than having those straddle two blocks.
+    """
+    return 1 << max(12, (int(blocksize) - 1).bit_length())
+
+
+def background_load(buffer, claims, priority):
+    (start_block, _) = claims[0]
+    print(f"[r] Async read of block {start_block}, blocks {len(claims)}")
+    try:
+        wanted = lambda: any(buffer.prefetch_wanted(block, event) for (block, event) in claims)
+        blocks = buffer.fetch_blocks(start_block, len(claims), priority=priority, wanted=wanted)
+        if blocks is None:
+            print(f"[x] dropped prefetch of block {start_block}")
+            return
+        buffer.load_async(blocks, start_block, prefetched=True)
+    except Exception as e:
+        print(f"[!] Async read of block {start_block} failed: {repr(e)}")
+    finally:
+        # Wake anyone waiting; if we failed, they'll load the blocks themselves.
+        for (block, event) in claims:
+            buffer.release(block, event)
+
+
+class PartialBlock:
+    """
+    A block being streamed in from the source, so readers can pass on the
+    bytes that have landed so far instead of waiting for all of it.
+    """
+    def __init__(self):
+        self.starts = []  # Offset (within the block) of each chunk.
+        self.chunks = []  # memoryviews, in order.
+        self.filled = 0
+        self.done = False
+        self.failed = False
+        self._cond = threading.Condition()
+
+    def append(self, chunk):
+        with self._cond:
+            self.starts.append(self.filled)
+            self.chunks.append(chunk)
+            self.filled += len(chunk)
+            self._cond.notify_all()
+
+    def finish(self, failed=False):
+        with self._cond:
+            self.done = True
+            self.failed = failed
+            self._cond.notify_all()
+
+    def landed(self, position, stop):
+        """
+        Return the slices of `[position, stop)` that have landed so far, without waiting.
+        """
+        out = []
+        with self._cond:
+            idx = max(0, bisect.bisect_right(self.starts, position) - 1)
+            while idx < len(self.chunks) and position < stop:
+                piece = self.chunks[idx][position - self.starts[idx]:stop - self.starts[idx]]
+                if piece:
+                    out.append(piece)
+                    position += len(piece)
+                idx += 1
+        return out
 
-def background_load(buffer, offset, length, block, blocks, delay_seconds=0):
-    time.sleep(delay_seconds)
-    print(f"[r] Async read of block {block} ({offset=}), blocks {blocks} ({length=})")
-    buffer.load_async(buffer.source(offset=offset, length=length), block, blocks)
+    def read(self, position, stop):
+        """
+        Yield `[position, stop)` as it lands.  Stops short at the end of the
+        block, or if loading it fails.
+        """
+        while position < stop:
+            with self._cond:
+                while self.filled <= position and not self.done:
+                    self._cond.wait()
+            pieces = self.landed(position, stop)
+            if not pieces:
+                return
+            for piece in pieces:
+                yield piece
+                position += len(piece)
+
+
+class AccessPattern:
+    """
+    Tracks whether a file is being read sequentially, and sizes a readahead
+    window (in blocks) to match: it doubles each time sequential reads cross
+    into a new block, and collapses to nothing when a read jumps elsewhere
+    (e.g. an ID3 tag scan or a thumbnailer probing the end of the file).
+
+    Re-reads of the region just read, or up to a block behind it (which
+    Music.app does a lot, and concurrent readers do out of order), don't
+    count either way.
+    """
+    def __init__(self, blocksize, initial=2, maximum=16):
+        self.blocksize = blocksize  # Also how far past (or behind) the last read still counts as "next" (or a re-read).
+        self.initial = initial
+        self.maximum = maximum
+        self.window = initial
+        self.sequential = None  # Unknown until the first read.
+        self.last_offset = None
+        self.next_offset = None
+
+    def record(self, offset, length):
+        end = offset + length
+        if self.next_offset is None:
+            self.sequential = (offset == 0)
+            self.window = self.initial if self.sequential else 0
+        elif self.next_offset <= offset <= self.next_offset + self.blocksize:
+            self.sequential = True
+            if (end - 1) // self.blocksize > (self.next_offset - 1) // self.blocksize:
+                self.window = min(self.maximum, max(1, self.window * 2))
+        elif min(self.last_offset, self.next_offset - self.blocksize) <= offset < self.next_offset:
+            end = max(end, self.next_offset)  # A re-read.
+        else:
+            self.sequential = False
+            self.window = 0
+
+        self.last_offset = offset
+        self.next_offset = end
+        return self.window
+
+    def stats(self):
+        return {"window": self.window, "sequential": self.sequential}
+
+
+class CacheStats:
+    """
+    Counters for every buffer of one backend, safe to bump from any thread.
+    """
+    COUNTERS = (
+        "hits",  # Served from memory, without waiting.
+        "misses",  # Had to wait for a load (ours or someone else's).
+        "prefetch_hits",  # First read of a block that a prefetch loaded.
+        "wasted_prefetches",  # Prefetched blocks evicted without ever being read.
+        "evictions",
+        "lower_hits",  # Blocks served by the lower (disk) tier instead of the source.
+        "fetches",  # Calls to the source.
+        "bytes_fetched",
+        "wait_seconds",  # Time readers spent blocked on misses.
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = dict.fromkeys(CacheStats.COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, counter, amount=1):
+        with self._lock:
+            self.counts[counter] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+STATS = {}  # backend name -> CacheStats
+_stats_lock = threading.Lock()
+
+
+def stats_for(name):
+    with _stats_lock:
+        if name not in STATS:
+            STATS[name] = CacheStats(name)
+        return STATS[name]
+
+
+DEFAULT_POOL_BYTES = 2**28  # 256 MiB
+DEFAULT_MAX_SHARE = 0.5
+
+
+class BlockPool:
+    """
+    An LRU of blocks keyed by (owner key, block index), bounded by one byte
+    budget no matter how many owners (files) share it.
+
+    Eviction is global LRU, except that no single owner may hold more than
+    `max_share` of the budget: past that, it evicts its own oldest blocks
+    first, so one long sequential read can't flush everyone else's hot blocks.
+    """
+    def __init__(self, max_bytes=DEFAULT_POOL_BYTES, max_blocks=None, max_share=DEFAULT_MAX_SHARE):
+        self.max_bytes = max_bytes
+        self.max_blocks = max_blocks
+        self.max_share = max_share
+        self.blocks = collections.OrderedDict()  # (key, block) -> bytes, least recently used first
+        self.owners = {}  # key -> OrderedDict(block -> None), least recently used first
+        self.owner_bytes = collections.Counter()
+        self.stored = 0  # bytes currently held in `self.blocks`
+        self.on_evict = {}  # key -> callback(block), for blocks evicted to stay under budget
+        self._lock = threading.RLock()
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def max_owner_bytes(self):
+        return int(self.max_bytes * self.max_share)
+
+    def has(self, key, block):
+        return (key, block) in self.blocks
+
+    def count(self, key):
+        return len(self.owners.get(key, ()))
+
+    def get(self, key, block):
+        """
+        Return the cached block (marking it most recently used), or None.
+        """
+        with self._lock:
+            bytez = self.blocks.get((key, block))
+            if bytez is not None:
+                self.blocks.move_to_end((key, block))
+                self.owners[key].move_to_end(block)
+            return bytez
+
+    def put(self, key, block, bytez):
+        """
+        Insert (or replace) a block as the most recently used, then evict
+        least recently used blocks until we're back under budget.
+        """
+        with self._lock:
+            self.invalidate(key, block)
+            self.blocks[(key, block)] = bytez
+            self.owners.setdefault(key, collections.OrderedDict())[block] = None
+            self.owner_bytes[key] += len(bytez)
+            self.stored += len(bytez)
+
+            # NOTE(mcotton): Never evict the block we just stored, even if it alone is over budget.
+            while (self.owner_bytes[key] > self.max_owner_bytes()) and self.count(key) > 1:
+                self.evict_block(key, next(iter(self.owners[key])))
+            self.evict(keep=(key, block))
+
+    def over_budget(self):
+        if (self.max_blocks is not None) and (len(self.blocks) > self.max_blocks):
+            return True
+        return self.stored > self.max_bytes
+
+    def evict(self, keep=None):
+        with self._lock:
+            while self.over_budget() and self.blocks:
+                worst = next(iter(self.blocks))
+                if worst == keep:
+                    if len(self.blocks) == 1:
+                        break
+                    self.blocks.move_to_end(worst)
+                    continue
+                self.evict_block(*worst)
+
+    def evict_block(self, key, block):
+        self.invalidate(key, block)
+        callback = self.on_evict.get(key)
+        if callback is not None:
+            callback(block)
+
+    def invalidate(self, key, block):
+        with self._lock:
+            bytez = self.blocks.pop((key, block), None)
+            if bytez is None:
+                return
+            print(f"[i] invalidating {key}:{block}")
+            self.stored -= len(bytez)
+            self.owner_bytes[key] -= len(bytez)
+            owner = self.owners[key]
+            del owner[block]
+            if not owner:
+                del self.owners[key]
+                del self.owner_bytes[key]
+
+    def drop(self, key):
+        with self._lock:
+            for block in list(self.owners.get(key, ())):
+                self.invalidate(key, block)
+
+    def stats(self):
+        return {
+            "stored_bytes": self.stored,
+            "max_bytes": self.max_bytes,
+            "blocks": len(self.blocks),
+            "owners": len(self.owners),
+        }
+
+
+SHARED_POOL = BlockPool()
 
 
 class BlockwiseBuffer(AbstractBuffer):
-    def __init__(self, source, size, blocksize=2_000_000, cache_limit=20, prefetch_blocks=2):
+    def __init__(self, source, size, key=None, pool=None, lower=None, executor=None, limiter=None, stats=None, blocksize=DEFAULT_IOSIZE, cache_limit=20, max_bytes=None, prefetch_blocks=2, max_prefetch_blocks=16, max_batch_blocks=4, stream=None):
+        blocksize = aligned_blocksize(blocksize)
         super().__init__(source, cap=blocksize, end=size)
+        self.stream = stream  # Optional `source` that yields chunks as they arrive, for demand reads to pass on before a block lands.
         self.blocksize = blocksize
-        self.cache_limit = cache_limit
-        self.prefetch_blocks = prefetch_blocks
-        self.cache = {}
-        self.stored = 0
-        self.hits = {}
-        self.requests = set()
-
-    def load_async(self, bytez, start_block, blocks):
-        print(f"[async receiving {start_block=}, {blocks=}]")
-        for idx in range(blocks):
-            block = (start_block + idx)
-            self.cache[block] = bytez[idx * self.blocksize:(idx + 1) * self.blocksize]
-            self.hits[block] = time.monotonic()
-            self.requests.remove(block)
+        self.max_batch_blocks = max(1, max_batch_blocks)  # Most blocks to fetch in a single call to `source`.
+        self.pattern = AccessPattern(blocksize, initial=prefetch_blocks, maximum=max(prefetch_blocks, max_prefetch_blocks))
+        if pool is None:
+            # A private pool, bounded the way a standalone buffer always was.
+            max_bytes = (cache_limit * blocksize) if max_bytes is None else max_bytes
+            pool = BlockPool(max_bytes=max_bytes, max_blocks=cache_limit, max_share=1.0)
+        self.pool = pool
+        self.key = id(self) if key is None else key
+        self.pool.on_evict[self.key] = self.evicted
+        self.counters = CacheStats(self.key) if stats is None else stats  # Usually shared by a whole backend.
+        self.prefetched = set()  # Blocks loaded by a prefetch, and not read yet.
+        self.lower = lower  # Optional slower tier (e.g. `DiskBlockCache`), only for content-addressed keys.
+        self.executor = prefetch.SHARED_EXECUTOR if executor is None else executor
+        self.limiter = limiter  # Optional `BackendLimiter`, shared by every buffer of one backend.
+        self.requests = {}  # block -> threading.Event, set once the block has landed (or failed)
+        self.prefetching = {}  # block -> (PrefetchTask, threading.Event, all claims of that task)
+        self.partial = {}  # block -> PartialBlock, while a demand read streams it in
+        self._lock = threading.Lock()
+
+    def load_async(self, blocks, start_block, prefetched=False):
+        print(f"[async receiving {start_block=}, blocks={len(blocks)}]")
+        for (idx, bytez) in enumerate(blocks):
+            self.store(start_block + idx, bytez)
+            if prefetched:
+                self.prefetched.add(start_block + idx)
+
+    def evicted(self, block):
+        self.counters.add("evictions")
+        if block in self.prefetched:
+            self.prefetched.discard(block)
+            self.counters.add("wasted_prefetches")
+
+    def used(self, block):
+        if block in self.prefetched:
+            self.prefetched.discard(block)
+            self.counters.add("prefetch_hits")
+
+    def claim(self, block):
+        """
+        Register interest in loading a block.
+
+        Returns `(event, owner)`: if `owner` is True, the caller must load the
+        block and then `release()` it; otherwise someone else is already
+        loading it, and the caller may wait on `event`.
+        """
+        with self._lock:
+            if block in self.requests:
+                return (self.requests[block], False)
+            event = self.requests[block] = threading.Event()
+            return (event, True)
+
+    def claim_run(self, block, until):
+        """
+        Claim the missing, unclaimed blocks directly after `block` (up to
+        `until`, inclusive), so they can be fetched along with it.
+        """
+        claims = []
+        for next_block in range(block + 1, min(until, block + self.max_batch_blocks - 1) + 1):
+            if self.cached(next_block) or self.block_length(next_block) <= 0:
+                break
+            (event, owner) = self.claim(next_block)
+            if not owner:
+                break
+            claims.append((next_block, event))
+        return claims
+
+    def release(self, block, event):
+        """
+        Give up the claim on a block, waking everyone waiting on it.
+        """
+        with self._lock:
+            if self.requests.get(block) is event:
+                del self.requests[block]
+            if self.prefetching.get(block, (None, None, None))[1] is event:
+                del self.prefetching[block]
+        event.set()
+
+    def prefetch_wanted(self, block, event):
+        return self.prefetching.get(block, (None, None, None))[1] is event
+
+    def cancel_prefetch(self, keep=()):
+        """
+        Cancel queued prefetches of blocks not in `keep` (e.g. after a seek,
+        or when the file is closed).  Prefetches still waiting on the backend
+        limiter are dropped once they get their turn; ones already fetching
+        are left be.
+
+        A batch is cancelled as a whole, if any of its blocks is stale.
+        """
+        with self._lock:
+            stale = [self.prefetching.pop(block) for block in list(self.prefetching) if block not in keep]
+        for (task, _, claims) in stale:
+            if task.cancel():
+                print(f"[x] cancelled prefetch of blocks {[block for (block, _) in claims]}")
+                for (block, event) in claims:
+                    self.release(block, event)
+
+    def steal_prefetch(self, block, event):
+        """
+        If `block` is claimed (with `event`) by a prefetch that hasn't started
+        yet, cancel it, so a demand read loads the block itself instead of
+        queuing behind other files' prefetches.  Returns whether it did.
+        """
+        with self._lock:
+            (task, prefetch_event, claims) = self.prefetching.get(block, (None, None, None))
+        if task is None or prefetch_event is not event or not task.cancel():
+            return False
+        print(f"[x] cancelled prefetch of blocks {[claimed for (claimed, _) in claims]}, to read block {block} now")
+        for (claimed, claimed_event) in claims:
+            self.release(claimed, claimed_event)
+        return True
+
+    def close(self):
+        self.cancel_prefetch()
+
+    def stats(self):
+        return {
+            **self.counters.snapshot(),
+            **self.pattern.stats(),
+            "cached_blocks": self.cached_blocks(),
+            "pending_blocks": len(self.requests),
+        }
 
     def block(self, byte):
-        return int(byte / self.blocksize)
+        return byte // self.blocksize
 
     def next_block(self, byte):
         return self.block(byte) + 1
@@ -62,133 +457,377 @@ class BlockwiseBuffer(AbstractBuffer):
     def blocks(self, offset, length):
         return list(range(self.block(offset), self.block(offset + length) + 1))
 
+    def cached(self, block):
+        return self.pool.has(self.key, block)
+
     def cached_blocks(self):
-        return len(self.cache)
+        return self.pool.count(self.key)
 
-    def worst_block(self):
-        return min(self.hits.keys(), key=lambda k: self.hits[k])
+    def store(self, block, bytez):
+        self.pool.put(self.key, block, bytez)
 
     def invalidate(self, block=None):
         if block is None:
-            block = self.worst_block()
-        print(f"[i] invalidating {block}")
-        del self.cache[block]
-        del self.hits[block]
-
-    def prefetch(self, offset):
-        for idx in range(self.prefetch_blocks):
-            next_block = (self.next_block(offset) + idx)
-            if (next_block in self.cache) or (next_block in self.requests):
+            self.pool.drop(self.key)
+        else:
+            self.pool.invalidate(self.key, block)
+
+    def block_length(self, block):
+        if self.end is None:
+            return self.blocksize
+        return max(0, min(self.blocksize, self.end - (block * self.blocksize)))
+
+    def fetch_blocks(self, start_block, blocks, priority=prefetch.DEMAND, wanted=None):
+        """
+        Read consecutive blocks, taking what we can from the lower tier and
+        the rest from the source in a single ranged call (writing them
+        through to the lower tier).  Returns a list of blocks, which stops
+        early at the end of the file.
+
+        If `wanted` is given and returns False by the time the backend is
+        free, return None without fetching.
+        """
+        out = []
+        if self.lower is not None:
+            while len(out) < blocks:
+                bytez = self.lower.get(self.key, start_block + len(out), self.blocksize)
+                if bytez is None:
+                    break
+                out.append(bytez)
+                self.counters.add("lower_hits")
+        if len(out) == blocks:
+            return out
+
+        first = start_block + len(out)
+        count = blocks - len(out)
+        offset = first * self.blocksize
+        length = sum(self.block_length(first + idx) for idx in range(count))
+        if length <= 0:
+            return out
+
+        if self.limiter is None:
+            payload = self.source(offset=offset, length=length)
+        else:
+            with self.limiter.slot(priority):
+                if (wanted is not None) and not wanted():
+                    return None
+                payload = self.source(offset=offset, length=length)
+        self.counters.add("fetches")
+        self.counters.add("bytes_fetched", len(payload))
+
+        if (self.end is None) and (len(payload) < length):
+            self.end = offset + len(payload)
+
+        for idx in range(count):
+            if count == 1:
+                bytez = payload
+            else:
+                bytez = payload[idx * self.blocksize:(idx + 1) * self.blocksize]
+                if not bytez:
+                    break
+            out.append(bytez)
+            if self.lower is not None and bytez:
+                self.lower.put(self.key, first + idx, self.blocksize, bytez)
+        return out
+
+    def get_block(self, block, until=None):
+        """
+        Return a block, loading it if needed.
+
+        Concurrent callers for the same block share a single load: the first
+        one fetches it, and the rest wait until it lands.  The loader also
+        fetches any missing blocks after it, up to block `until`, in the
+        same call to the source.
+        """
+        bytez = self.pool.get(self.key, block)  # rewards a cache hit.
+        if bytez is not None:
+            self.counters.add("hits")
+            self.used(block)
+            return bytez
+
+        self.counters.add("misses")
+        t0 = time.perf_counter()
+        try:
+            return self.load_block(block, until)
+        finally:
+            self.counters.add("wait_seconds", time.perf_counter() - t0)
+
+    def load_block(self, block, until):
+        while True:
+            (event, owner) = self.claim(block)
+            if owner:
+                break
+            if self.steal_prefetch(block, event):
+                continue
+            print(f"[ ] Waiting for pending request of block {block}...")
+            event.wait()
+            # NOTE(mcotton): If that load failed, or the block was already evicted, we loop and load it ourselves.
+            bytez = self.pool.get(self.key, block)
+            if bytez is not None:
+                self.used(block)
+                return bytez
+
+        claims = [(block, event)]
+        try:
+            bytez = self.pool.get(self.key, block)  # It may have landed between our check and our claim.
+            if bytez is None:
+                claims += self.claim_run(block, block if until is None else until)
+                print(f"[r] Sync read of block {block}, blocks {len(claims)}")
+                blocks = self.fetch_blocks(block, len(claims))
+                self.load_async(blocks, block)
+                bytez = blocks[0] if blocks else b''
+        finally:
+            for (claimed, claimed_event) in claims:
+                self.release(claimed, claimed_event)
+        return bytez
+
+    def block_chunks(self, block, start, stop, until=None):
+        """
+        Yield `block[start:stop]` as memoryviews.  With a `stream` source, a
+        missing block is passed on as it streams in (whoever is loading it),
+        rather than once all of it has landed.
+        """
+        if self.stream is None:
+            chunk = memoryview(self.get_block(block, until=until))[start:stop]
+            if chunk:
+                yield chunk
+            return
+
+        bytez = self.pool.get(self.key, block)  # rewards a cache hit.
+        if bytez is not None:
+            self.counters.add("hits")
+            self.used(block)
+        else:
+            self.counters.add("misses")
+        while bytez is None:
+            (event, owner) = self.claim(block)
+            if owner:
+                yield from self.stream_block(block, event, start, stop, until)
+                return
+            if self.steal_prefetch(block, event):
+                continue
+            with self._lock:
+                partial = self.partial.get(block)
+            if partial is None:
+                print(f"[ ] Waiting for pending request of block {block}...")
+                t0 = time.perf_counter()
+                event.wait()
+                self.counters.add("wait_seconds", time.perf_counter() - t0)
+            else:
+                for piece in partial.read(start, stop):
+                    yield piece
+                    start += len(piece)
+                if not partial.failed:
+                    return
+            # NOTE(mcotton): If that load failed, or the block was already evicted, we loop and load it ourselves.
+            bytez = self.pool.get(self.key, block)
+            if bytez is not None:
+                self.used(block)
+
+        chunk = memoryview(bytez)[start:stop]
+        if chunk:
+            yield chunk
+
+    def stream_block(self, block, event, start, stop, until):
+        """
+        Load a block we've claimed (and any missing blocks after it, up to
+        `until`) from `stream`, yielding `block[start:stop]` as it lands.
+        Anyone else reading these blocks meanwhile follows along through
+        `self.partial`.
+        """
+        claims = [(block, event)]
+        try:
+            bytez = self.pool.get(self.key, block)  # It may have landed between our check and our claim.
+            if bytez is None and self.lower is not None:
+                bytez = self.lower.get(self.key, block, self.blocksize)
+                if bytez is not None:
+                    self.counters.add("lower_hits")
+                    self.store(block, bytez)
+            if bytez is not None:
+                chunk = memoryview(bytez)[start:stop]
+                if chunk:
+                    yield chunk
+                return
+
+            claims += self.claim_run(block, block if until is None else until)
+            partials = [PartialBlock() for _ in claims]
+            with self._lock:
+                for ((claimed, _), partial) in zip(claims, partials):
+                    self.partial[claimed] = partial
+            print(f"[r] Streamed read of block {block}, blocks {len(claims)}")
+
+            fill = self.fill(block, partials)
+            try:
+                t0 = time.perf_counter()
+                for _ in fill:
+                    self.counters.add("wait_seconds", time.perf_counter() - t0)
+                    for piece in partials[0].landed(start, stop):
+                        yield piece
+                        start += len(piece)
+                    t0 = time.perf_counter()
+            finally:
+                # NOTE(mcotton): If our reader gave up part-way, finish the load anyway: others may be following along.
+                try:
+                    for _ in fill:
+                        pass
+                except Exception as e:
+                    print(f"[!] Streamed read of block {block} failed: {repr(e)}")
+        finally:
+            with self._lock:
+                for (claimed, _) in claims:
+                    self.partial.pop(claimed, None)
+            for (claimed, claimed_event) in claims:
+                self.release(claimed, claimed_event)
+
+    def fill(self, start_block, partials):
+        """
+        Stream consecutive blocks from the source into `partials`, yielding
+        after each chunk.  Each block goes into the pool (and the lower tier)
+        as soon as it's complete.
+        """
+        offset = start_block * self.blocksize
+        length = sum(self.block_length(start_block + idx) for idx in range(len(partials)))
+        idx = 0
+        try:
+            with (self.limiter.slot(prefetch.DEMAND) if self.limiter is not None else contextlib.nullcontext()):
+                for chunk in self.stream(offset=offset, length=length):
+                    chunk = memoryview(chunk)
+                    self.counters.add("bytes_fetched", len(chunk))
+                    while chunk and idx < len(partials):
+                        piece = chunk[:self.blocksize - partials[idx].filled]
+                        partials[idx].append(piece)
+                        chunk = chunk[len(piece):]
+                        if partials[idx].filled == self.blocksize:
+                            self.complete(start_block + idx, partials[idx])
+                            idx += 1
+                    yield
+        except Exception:
+            for partial in partials[idx:]:
+                partial.finish(failed=True)
+            raise
+        self.counters.add("fetches")
+
+        filled = sum(partial.filled for partial in partials)
+        if (self.end is None) and (filled < length):
+            self.end = offset + filled
+        for (rest, partial) in enumerate(partials[idx:], start=start_block + idx):
+            self.complete(rest, partial)  # Short, at the end of the file.
+
+    def complete(self, block, partial):
+        bytez = b"".join(partial.chunks)
+        if bytez:
+            self.store(block, bytez)
+            if self.lower is not None:
+                self.lower.put(self.key, block, self.blocksize, bytez)
+        partial.finish()
+
+    def prefetch(self, offset, length=1):
+        """
+        Queue background loads for the readahead window after this read,
+        cancelling queued loads that fall outside it.  Runs of adjacent
+        missing blocks are batched into a single load.
+        """
+        block = self.block(offset + max(length, 1) - 1)
+        first = block + 1
+        # Never read further ahead than our share of the pool holds, or prefetches just evict each other.
+        # NOTE(mcotton): Each block read moves to the front of the LRU, so by the time a prefetched block is read, up to a
+        # window's worth of blocks read *and* a window's worth prefetched after it have all been used more recently: hence half.
+        capacity = self.pool.max_owner_bytes() // self.blocksize
+        if self.pool.max_blocks is not None:
+            capacity = min(capacity, self.pool.max_blocks)
+        window = max(0, min(self.pattern.window, (capacity - 1 - (block - self.block(offset))) // 2))
+        if self.end is not None:
+            window = max(0, min(window, self.block(self.end - 1) + 1 - first))  # Nothing to fetch past the end of the file.
+        self.cancel_prefetch(keep=range(self.block(offset), first + window))
+
+        # NOTE(mcotton): As a sequential read slides the window along, only one block at a time goes missing.
+        # Wait until a full batch is missing (as long as enough is still coming) rather than fetch them one by one.
+        missing = sum(
+            1 for next_block in range(first, first + window)
+            if not (self.cached(next_block) or next_block in self.requests)
+        )
+        if missing < self.max_batch_blocks and (window - missing) >= self.max_batch_blocks:
+            return
+
+        claims = []
+        for next_block in range(first, first + window):
+            if self.block_length(next_block) <= 0:
+                break
+            if self.cached(next_block):
+                self.queue_prefetch(claims, first)
+                claims = []
                 continue
 
-            blocks = 1  # NOTE(mcotton): We always request 1 block at a time.
-            offset = next_block * self.blocksize
-            length = blocks * self.blocksize
+            (event, owner) = self.claim(next_block)
+            if not owner:
+                self.queue_prefetch(claims, first)
+                claims = []
+                continue
 
-            if (self.end is not None):
-                remaining = self.end - offset
-                if remaining < 0:
-                    continue
-                length = min(length, remaining)
-
-            print(f"(starting background load for: {next_block})")
-            delay_seconds = (idx + 1) * 0.5
-            start_background_load(
-                buffer=self,
-                offset=offset,
-                length=length,
-                block=next_block,
-                blocks=blocks,
-                delay_seconds=delay_seconds,
-            )
-            self.requests.add(next_block)
+            claims.append((next_block, event))
+            if len(claims) == self.max_batch_blocks:
+                self.queue_prefetch(claims, first)
+                claims = []
+        self.queue_prefetch(claims, first)
+
+    def queue_prefetch(self, claims, first):
+        if not claims:
+            return
+        print(f"(queueing background load for: {[block for (block, _) in claims]})")
+        priority = claims[0][0] - first + 1  # Nearest blocks first.
+        task = prefetch.PrefetchTask(background_load, self, claims, priority)
+        with self._lock:
+            for (block, event) in claims:
+                self.prefetching[block] = (task, event, claims)
+        self.executor.submit(priority, task)
 
     def read(self, offset, length):
-        print(self.hits)
-
+        chunks = list(self.read_chunks(offset, length))
+        if len(chunks) == 1 and chunks[0].nbytes == len(chunks[0].obj):
+            return chunks[0].obj  # Exactly one whole block: no copy at all.
+        return b"".join(chunks)  # Exactly one copy, however many blocks.
+
+    def read_chunks(self, offset, length):
+        """
+        Yield the requested range as memoryview slices of cached blocks, one
+        per block, as each block becomes available.  With a `stream` source,
+        a block being loaded comes out in pieces, as they arrive.
+        """
         if offset < 0 or length < 0:
             raise RuntimeError("Offset and length can't be negative.")
         elif length == 0:
-            out = b''
-
-        self.prefetch(offset)
-
-        block = self.block(offset)
-        if block not in self.cache and block not in self.requests:
-            out = self.new_read(offset, length)
-        elif block in self.requests:
-            print(f"[ ] Waiting for pending request...")
-            for _ in range(5):
-                time.sleep(0.1)
-                if block in self.cache:
-                    out = self.cache_read(offset, length)
-            else:
-                print(f"[!] Cache took too long to populate!")
-                raise RuntimeError("cache delay")
-        else:
-            print(f"read (DEBUG) offset={offset}, length={length}")
-            out = self.cache_read(offset, length)
-
-        if self.cached_blocks() >= self.cache_limit:
-            self.invalidate()
-
-        return out
-
-    def new_read(self, offset, length):
-        print(f"new_read({offset}, {length})")
-
-        block = self.block(offset)
-        print(f"[r] Sync read of block {block}")
-        if (self.end is not None):
-            remaining = self.end - (block * self.blocksize)
-            read = self.source(offset=block * self.blocksize, length=min(self.blocksize, remaining))
-        else:
-            read = self.source(offset=block * self.blocksize, length=self.blocksize)
-        self.cache[block] = read
-        self.hits[block] = time.monotonic()
-
-        if not self.end and (len(read) < self.blocksize):
-            # print("end found.")
-            self.end = offset + len(read)
-
-        out = read[offset % self.blocksize:offset % self.blocksize + length]
-        have = len(out)
-        if length < have:
-            raise RuntimeError("Grabbed too much data")
-        elif length == have:
-            self.prefetch(offset)
-            return out
-        elif self.end and (offset + have) >= self.end:
-            print(f"new_read at end.")
-            return out
-        else:
-            return out + self.read(offset + have, length - have)
-
-    def cache_read(self, offset, length):
-        print(f"cache_read({offset}, {length})")
-
-        block = self.block(offset)
-        read = self.cache[block]
-        self.hits[block] = time.monotonic()  # reward a cache hit.
-
-        out = read[offset % self.blocksize:offset % self.blocksize + length]
-        have = len(out)
-
-        # TODO(mcotton): Consider this carefully.
-        # if have <= length <= self.blocksize:
-        #     print(f"cache_read empty block")
-        #     # We have cached < blocksize, or even 0!
-        #     # If they asked for something that would be encapsulated
-        #     # in a single cache read, there's no reason to recurse or prefetch.
-        #     return out
-        if length < have:
-            raise RuntimeError("Grabbed too much data")
-        elif length == have:
-            self.prefetch(offset)
-            return out
-        elif self.end and (offset + have) >= self.end:
-            print(f"cache_read at end.")
-            return out
-        else:
-            print(f"cache_read (DEBUG) offset={offset}, have={have}, length={length}")
-            return out + self.read(offset + have, length - have)
+            return
+
+        with self._lock:
+            self.pattern.record(offset, length)
+        self.prefetch(offset, length)
+
+        print(f"read (DEBUG) offset={offset}, length={length}")
+        last = self.block(offset + length - 1)
+        have = 0
+        while have < length:
+            position = offset + have
+            block = self.block(position)
+            start = position - (block * self.blocksize)
+            for chunk in self.block_chunks(block, start, start + (length - have), until=last):
+                yield chunk
+                have += len(chunk)
+            if (offset + have == position) or ((self.end is not None) and (offset + have) >= self.end):
+                print(f"read at end.")
+                return
+
+
+def prometheus_metrics(prefix="mmfuse_cache"):
+    """
+    Render the cache counters (per backend) and the shared pool's usage in
+    Prometheus' text exposition format.
+    """
+    lines = []
+    for counter in CacheStats.COUNTERS:
+        lines.append(f"# TYPE {prefix}_{counter}_total counter")
+        for (name, stats) in sorted(STATS.items()):
+            lines.append(f'{prefix}_{counter}_total{{backend="{name}"}} {stats.snapshot()[counter]}')
+    for (gauge, value) in SHARED_POOL.stats().items():
+        lines.append(f"# TYPE {prefix}_pool_{gauge} gauge")
+        lines.append(f"{prefix}_pool_{gauge} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,98 @@
+import collections
+import os
+import pathlib
+import re
+import threading
+
+
+DEFAULT_DISK_BYTES = 2**33  # 8 GiB
+UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+class DiskBlockCache:
+    """
+    A size-capped LRU of blocks in a local directory, one file per block.
+
+    Blocks are keyed by content hash, block size and block index, so an entry
+    can never go stale; the only reason to drop one is to stay under budget.
+    Recency is kept in file mtimes, so LRU order survives restarts.
+    """
+    def __init__(self, root, max_bytes=DEFAULT_DISK_BYTES):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.files = collections.OrderedDict()  # filename -> size, least recently used first
+        self.stored = 0
+        self._lock = threading.Lock()
+
+        entries = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                os.unlink(entry.path)  # Left behind by an interrupted write.
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for (_, name, size) in sorted(entries):
+            self.files[name] = size
+            self.stored += size
+        self.evict()
+
+        print(f"ready: DiskBlockCache({self.root}, {len(self.files)} blocks, {self.stored} bytes)")
+
+    @staticmethod
+    def filename(key, block, blocksize):
+        return f"{UNSAFE_CHARS.sub('_', str(key))}.{blocksize}.{block}"
+
+    def get(self, key, block, blocksize):
+        name = DiskBlockCache.filename(key, block, blocksize)
+        with self._lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+
+        path = self.root / name
+        try:
+            bytez = path.read_bytes()
+            os.utime(path)  # reward a cache hit.
+        except FileNotFoundError:
+            with self._lock:
+                self.stored -= self.files.pop(name, 0)
+            return None
+        print(f"[d] disk hit {name}")
+        return bytez
+
+    def put(self, key, block, blocksize, bytez):
+        name = DiskBlockCache.filename(key, block, blocksize)
+        if len(bytez) > self.max_bytes:
+            return
+        with self._lock:
+            if name in self.files:
+                return
+
+        path = self.root / name
+        tmp = path.with_name(f"{name}.{threading.get_ident()}.tmp")
+        try:
+            tmp.write_bytes(bytez)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[!] disk cache write failed for {name}: {repr(e)}")
+            tmp.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            if name not in self.files:
+                self.files[name] = len(bytez)
+                self.stored += len(bytez)
+        self.evict()
+
+    def evict(self):
+        while True:
+            with self._lock:
+                if self.stored <= self.max_bytes or not self.files:
+                    return
+                (name, size) = self.files.popitem(last=False)
+                self.stored -= size
+            print(f"[i] evicting {name} from disk")
+            (self.root / name).unlink(missing_ok=True)
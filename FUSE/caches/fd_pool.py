@@ -0,0 +1,98 @@
+import collections
+import contextlib
+import os
+import threading
+
+
+DEFAULT_MAX_FDS = 64
+
+
+class Handle:
+    def __init__(self, fd):
+        self.fd = fd
+        self.refs = 0
+        self.evicted = False  # Out of the pool; closed once the last user is done.
+
+
+class FilePool:
+    """
+    A bounded LRU of read-only file descriptors, one per path, shared by
+    every thread.  Reads use `os.pread`, so threads never fight over a file
+    position.
+
+    A descriptor in use is never closed under its user: if it's evicted
+    meanwhile, it's closed when released.  So the pool can briefly hold more
+    than `max_fds`, if that many are in use at once.
+    """
+    def __init__(self, max_fds=DEFAULT_MAX_FDS):
+        self.max_fds = max_fds
+        self.handles = collections.OrderedDict()  # path -> Handle, least recently used first
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def fd(self, path):
+        handle = self._acquire(path)
+        try:
+            yield handle.fd
+        finally:
+            self._release(handle)
+
+    def _acquire(self, path):
+        with self._lock:
+            handle = self.handles.get(path)
+            if handle is not None:
+                self.handles.move_to_end(path)
+                handle.refs += 1
+                return handle
+
+        fd = os.open(path, os.O_RDONLY)  # NOTE(mcotton): Outside the lock, in case the disk is slow (or asleep).
+        with self._lock:
+            handle = self.handles.get(path)
+            if handle is None:
+                handle = self.handles[path] = Handle(fd)
+                fd = None
+            handle.refs += 1
+            self._evict()
+        if fd is not None:
+            os.close(fd)  # Someone else opened it first.
+        return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.refs -= 1
+            if not (handle.evicted and handle.refs == 0):
+                return
+        os.close(handle.fd)
+
+    def _evict(self):
+        idle = [path for (path, handle) in self.handles.items() if handle.refs == 0]
+        for path in idle[:max(0, len(self.handles) - self.max_fds)]:
+            handle = self.handles.pop(path)
+            handle.evicted = True
+            os.close(handle.fd)
+
+    def pread(self, path, length, offset):
+        """
+        Read up to `length` bytes at `offset`, fewer only at the end of the file.
+        """
+        with self.fd(path) as fd:
+            out = os.pread(fd, length, offset)
+            if len(out) == length or not out:
+                return out
+            chunks = [out]
+            got = len(out)
+            while got < length:
+                chunk = os.pread(fd, length - got, offset + got)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                got += len(chunk)
+            return b"".join(chunks)
+
+    def close(self):
+        with self._lock:
+            (handles, self.handles) = (self.handles, collections.OrderedDict())
+            for handle in handles.values():
+                handle.evicted = True
+                if handle.refs == 0:
+                    os.close(handle.fd)
@@ -0,0 +1,74 @@
+import errno
+import mmap
+import os
+import threading
+
+from FUSE.caches import block_cache
+
+
+class MappedFile:
+    """
+    A local file mapped read-only, in place of a `BlockwiseBuffer`: reads are
+    memoryview slices of the mapping, so the data is only ever in the page
+    cache, never copied into (or double-counted by) the block pool.
+
+    The same `AccessPattern` that sizes a buffer's readahead drives
+    `madvise` instead: sequential reads ask the kernel to read the window
+    ahead (`MADV_WILLNEED`), and a jump switches it to `MADV_RANDOM`.
+    """
+    def __init__(self, path, blocksize=block_cache.DEFAULT_IOSIZE, prefetch_blocks=2, max_prefetch_blocks=16):
+        self.path = path
+        self.blocksize = blocksize
+        self.pattern = block_cache.AccessPattern(blocksize, initial=prefetch_blocks, maximum=max(prefetch_blocks, max_prefetch_blocks))
+        self.advice = None
+        self.closed = False
+        self._lock = threading.Lock()
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.size = os.fstat(fd).st_size
+            # NOTE(mcotton): Empty files can't be mapped.  The mapping outlives the descriptor.
+            self.map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ) if self.size else None
+        finally:
+            os.close(fd)
+
+    def read(self, offset, length):
+        if offset < 0 or length < 0:
+            raise ValueError(f"Invalid read: {offset=}, {length=}")
+        mapped = self.map
+        if self.closed:
+            raise OSError(errno.EBADF, f"Read from closed mapping of {self.path}")
+        if mapped is None or offset >= self.size:
+            return b""
+        try:
+            self.advise(mapped, offset, length)
+            return memoryview(mapped)[offset:offset + length]
+        except ValueError:
+            raise OSError(errno.EBADF, f"Read from closed mapping of {self.path}")  # Closed between our check and our read.
+
+    def read_chunks(self, offset, length):
+        return iter([self.read(offset, length)])
+
+    def advise(self, mapped, offset, length):
+        if not hasattr(mapped, "madvise"):
+            return  # Python < 3.8, or a platform without it.
+        with self._lock:
+            window = self.pattern.record(offset, length)
+            advice = mmap.MADV_SEQUENTIAL if self.pattern.sequential else mmap.MADV_RANDOM
+            if advice != self.advice:
+                mapped.madvise(advice)
+                self.advice = advice
+        if window:
+            start = ((offset + length) // mmap.PAGESIZE) * mmap.PAGESIZE
+            if start < self.size:
+                mapped.madvise(mmap.MADV_WILLNEED, start, min(window * self.blocksize, self.size - start))
+
+    def close(self):
+        self.closed = True
+        if self.map is None:
+            return
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # A read's memoryview is still alive; the mapping goes once it does.
+        self.map = None
@@ -0,0 +1,128 @@
+import collections
+import errno
+import posixpath
+import threading
+import time
+
+
+CACHED_FUNCS = frozenset(["getattr", "readdir", "readdirplus", "statfs"])
+LISTING_FUNCS = frozenset(["readdir", "readdirplus"])
+
+DEFAULT_MAX_ENTRIES = 2**16
+DEFAULT_TTL = 60.0  # seconds
+DEFAULT_NEGATIVE_TTL = 5.0  # seconds, for errors like ENOENT
+
+# Errors that depend on who's asking, not on what's there, so can't be shared between processes.
+UNCACHED_ERRORS = frozenset([errno.EACCES, errno.EPERM])
+
+
+class MetadataCache:
+    """
+    A bounded LRU of `getattr`/`readdir`/`statfs` responses (`{"result",
+    "error"}` dicts), shared by every process asking.
+
+    Entries expire after `ttl` seconds, and errors after `negative_ttl`, so a
+    file that appears later is seen soon.  A `ttl` of None never expires.
+    Keys leave out the process name: callers check permissions first.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = collections.OrderedDict()  # key -> (expires, out), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(funcname, args, kwargs):
+        return (funcname, tuple(args), tuple(sorted(kwargs.items())))
+
+    def get(self, key):
+        with self._lock:
+            cached = self.entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            (expires, out) = cached
+            if expires is not None and expires <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return out
+
+    def put(self, key, out):
+        ttl = self.ttl if out["error"] is None else self.negative_ttl
+        if out["error"] in UNCACHED_ERRORS or ttl == 0:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self.entries[key] = (expires, out)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def call(self, funcname, args, kwargs, func):
+        """
+        Return the cached response for this call, or `func()`'s (and cache it).
+        """
+        key = MetadataCache.key(funcname, args, kwargs)
+        out = self.get(key)
+        if out is None:
+            out = func()
+            self.put(key, out)
+        return out
+
+    def invalidate(self, path=None):
+        """
+        Forget everything about `path` (and its parent's listing), or everything at all.
+        """
+        with self._lock:
+            if path is None:
+                self.entries.clear()
+                return
+            parent = posixpath.dirname(path.rstrip("/")) or "/"
+            for key in list(self.entries):
+                (funcname, args, _) = key
+                if args and (args[0] == path or (funcname in LISTING_FUNCS and args[0] == parent)):
+                    del self.entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class Admissions:
+    """
+    A bounded LRU of which processes the server has let at which paths, so
+    a client only serves cached responses to processes it would have let
+    in too.  A forgotten admission just means asking the server again.
+    """
+    def __init__(self, max_paths=DEFAULT_MAX_ENTRIES):
+        self.max_paths = max_paths
+        self.paths = collections.OrderedDict()  # path -> process names, least recently used first
+        self._lock = threading.Lock()
+
+    def admitted(self, procname, path):
+        with self._lock:
+            procnames = self.paths.get(path)
+            if procnames is None:
+                return False
+            self.paths.move_to_end(path)
+            return procname in procnames
+
+    def admit(self, procname, path):
+        with self._lock:
+            self.paths.setdefault(path, set()).add(procname)
+            self.paths.move_to_end(path)
+            while len(self.paths) > self.max_paths:
+                self.paths.popitem(last=False)
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self.paths.clear()
+            else:
+                self.paths.pop(path, None)
@@ -0,0 +1,116 @@
+import contextlib
+import heapq
+import itertools
+import queue
+import threading
+
+
+DEFAULT_WORKERS = 4
+DEMAND = 0  # Priority of a read that a caller is blocked on; prefetches use their distance in blocks (>= 1).
+
+
+class BackendLimiter:
+    """
+    Caps the number of concurrent calls into one backend.
+
+    When the backend is saturated, the waiter with the lowest priority goes
+    next, so a demand read jumps ahead of queued prefetches.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=DEMAND):
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self.waiting, ticket)
+            while not (self.active < self.limit and self.waiting[0] == ticket):
+                self._cond.wait()
+            heapq.heappop(self.waiting)
+            self.active += 1
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority=DEMAND):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class PrefetchTask:
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.started = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Cancel the task if it hasn't started yet.  Returns whether it was cancelled.
+        """
+        with self._lock:
+            if self.started:
+                return False
+            self.cancelled = True
+            return True
+
+    def run(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.started = True
+        self.func(*self.args)
+
+
+class PrefetchExecutor:
+    """
+    A fixed pool of worker threads serving prefetches from one priority
+    queue, nearest blocks first.  Cancelled tasks are skipped when dequeued.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def resize(self, workers):
+        """
+        Set the pool size.  Meant for startup: running workers are never stopped.
+        """
+        with self._lock:
+            self.workers = workers
+            self._start()
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            t = threading.Thread(target=self._work, name=f"prefetch-{len(self._threads)}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, priority, task):
+        with self._lock:
+            self._start()  # NOTE(mcotton): Lazily, so importing this module doesn't spawn threads.
+        self.queue.put((priority, next(self._seq), task))
+
+    def _work(self):
+        while True:
+            (_, _, task) = self.queue.get()
+            try:
+                task.run()
+            except Exception as e:
+                print(f"[!] prefetch task failed: {repr(e)}")
+
+
+SHARED_EXECUTOR = PrefetchExecutor()
@@ -0,0 +1,50 @@
+import collections
+import threading
+import time
+
+import psutil
+
+
+DEFAULT_TTL = 2.0  # seconds
+DEFAULT_MAX_PROCESSES = 1024
+
+
+class ProcessNames:
+    """
+    A pid -> process name cache, for identifying the caller of every FUSE call.
+
+    Within `ttl` of the last check, a name is trusted as-is.  After that, it's
+    always read again: `exec` keeps a process's PID and start time, but not
+    its name.  (A PID reused, or a process `exec`ing, within `ttl` goes
+    unnoticed, so keep it short.)
+    """
+    def __init__(self, ttl=DEFAULT_TTL, max_processes=DEFAULT_MAX_PROCESSES):
+        self.ttl = ttl
+        self.max_processes = max_processes
+        self.processes = collections.OrderedDict()  # pid -> (start time, name, last checked)
+        self._lock = threading.Lock()
+
+    def name(self, pid):
+        now = time.monotonic()
+        with self._lock:
+            cached = self.processes.get(pid)
+            if cached is not None:
+                self.processes.move_to_end(pid)
+                (start_time, name, checked) = cached
+                if now - checked < self.ttl:
+                    return name
+
+        proc = psutil.Process(pid)  # NOTE(mcotton): Reads the start time, to tell processes apart.
+        start_time = proc.create_time()
+        name = proc.name()
+        if not proc.is_running():
+            raise psutil.NoSuchProcess(pid)  # The PID was reused while we looked, so that name may be someone else's.
+        if cached is not None and cached[0] != start_time:
+            print(f"[i] PID {pid} was reused: {cached[1]} -> {name}")
+
+        with self._lock:
+            self.processes[pid] = (start_time, name, now)
+            self.processes.move_to_end(pid)
+            while len(self.processes) > self.max_processes:
+                self.processes.popitem(last=False)
+        return name
@@ -0,0 +1,122 @@
+"""
+Optional compression of msgpack'd metadata responses (e.g. big `readdir`s).
+
+The client lists the codecs it has (`AVAILABLE`, fastest first) with each
+call; the server uses the first of those it has too, but only for metadata
+calls whose response is at least `MIN_BYTES`, and only if it actually
+shrinks.  Block data is never compressed: it's media, already compressed.
+"""
+
+import collections
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+COMPRESSIBLE_FUNCS = frozenset(["getattr", "readdir", "readdirplus", "statfs"])
+
+MIN_BYTES = 2**12  # Below this, compressing costs more than it saves.
+MIN_SAVING = 0.1  # Send uncompressed unless at least this much smaller.
+
+_local = threading.local()
+
+
+def _zstd_compress(bytez):
+    # NOTE(mcotton): zstandard (de)compressors aren't thread-safe, and every server worker compresses, so one per thread.
+    if not hasattr(_local, "zstd"):
+        _local.zstd = zstandard.ZstdCompressor(level=3)
+    return _local.zstd.compress(bytez)
+
+
+CODECS = {}  # name -> (compress, decompress), fastest first
+if zstandard is not None:
+    CODECS["zstd"] = (_zstd_compress, lambda bytez: zstandard.ZstdDecompressor().decompress(bytez))
+if lz4 is not None:
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+CODECS["zlib"] = (lambda bytez: zlib.compress(bytez, 1), zlib.decompress)
+
+AVAILABLE = tuple(CODECS)
+
+
+class CompressionStats:
+    COUNTERS = ("responses", "skipped", "bytes_in", "bytes_out", "compress_seconds", "decompress_seconds")
+
+    def __init__(self):
+        self.counters = collections.defaultdict(collections.Counter)  # codec -> counter -> value
+        self._lock = threading.Lock()
+
+    def add(self, codec, **counts):
+        with self._lock:
+            self.counters[codec].update(counts)
+
+    def snapshot(self):
+        with self._lock:
+            out = {}
+            for (codec, counter) in self.counters.items():
+                out[codec] = {name: counter[name] for name in CompressionStats.COUNTERS}
+                out[codec]["ratio"] = counter["bytes_out"] / counter["bytes_in"] if counter["bytes_in"] else None
+            return out
+
+
+STATS = CompressionStats()
+
+
+def choose(funcname, length, accept):
+    """
+    Return the codec to compress this response with, or None.
+    """
+    if funcname not in COMPRESSIBLE_FUNCS or length < MIN_BYTES:
+        return None
+    for codec in accept:
+        if codec in CODECS:
+            return codec
+    return None
+
+
+def encode(funcname, packed, accept):
+    """
+    Return `(codec, bytes)`: `packed` compressed with the negotiated codec,
+    or `(None, packed)` if it isn't worth it.
+    """
+    codec = choose(funcname, len(packed), accept)
+    if codec is None:
+        return (None, packed)
+
+    t0 = time.thread_time()
+    compressed = CODECS[codec][0](packed)
+    dt = time.thread_time() - t0
+    if len(compressed) > len(packed) * (1 - MIN_SAVING):
+        STATS.add(codec, skipped=1, compress_seconds=dt)
+        return (None, packed)
+    STATS.add(codec, responses=1, bytes_in=len(packed), bytes_out=len(compressed), compress_seconds=dt)
+    return (codec, compressed)
+
+
+def decode(codec, bytez):
+    t0 = time.thread_time()
+    out = CODECS[codec][1](bytez)
+    STATS.add(codec, decompress_seconds=time.thread_time() - t0)
+    return out
+
+
+def prometheus_metrics(prefix="mmfuse_compression"):
+    """
+    Render `STATS` in the Prometheus text exposition format.
+    """
+    snapshot = STATS.snapshot()
+    lines = []
+    for name in CompressionStats.COUNTERS:
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        for (codec, counters) in snapshot.items():
+            lines.append(f'{prefix}_{name}_total{{codec="{codec}"}} {counters[name]}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+"""
+Mounts a backend in-process: `Fuse2Rest`, but calling `rest2passthrough`'s
+dispatch directly instead of over HTTP or a socket.
+
+For when the mount and the backend are on the same host, this skips
+serialization and a socket round trip per call.  Use `fuse2rest` and
+`rest2passthrough` to mount a remote backend.
+"""
+
+import argparse
+
+from FUSE import fuse2rest, rest2passthrough
+from FUSE.caches import process_names
+
+
+class Fuse2Local(fuse2rest.Fuse2Rest):
+    def __init__(self, procname_ttl=process_names.DEFAULT_TTL):
+        # NOTE(mcotton): No `assume_static`: `dispatch` already caches metadata, and there's no round trip to save.
+        super().__init__("local", procname_ttl=procname_ttl)
+
+    def _call(self, procname, funcname, *args, **kwargs):
+        out = rest2passthrough.dispatch(funcname, args, kwargs, procname)
+        if isinstance(out["result"], memoryview):
+            out["result"] = bytes(out["result"])  # NOTE(mcotton): fusepy can only `memmove` from bytes (e.g. not an `--mmap` read).
+        return out
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mountpoint")
+    rest2passthrough.add_backend_args(parser)
+
+    parser.add_argument("--threads", default=False, action="store_true",
+        help="Let FUSE make concurrent calls")
+    parser.add_argument("--procname-ttl", default=process_names.DEFAULT_TTL, type=float,
+        help="Seconds to trust a cached process name before re-checking its PID wasn't reused")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rest2passthrough.setup(args)
+    fuse2rest.mount(Fuse2Local(procname_ttl=args.procname_ttl), args.mountpoint, threads=args.threads, iosize=args.iosize)
+
+
+if __name__ == '__main__':
+    main()
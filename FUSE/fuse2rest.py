@@ -9,7 +9,7 @@ import base64
 import functools
 import logging
 import pathlib
-import psutil
+import posixpath
 import socket
 import threading
 import time
@@ -20,6 +20,9 @@ import fuse
 import msgpack
 import requests
 
+from FUSE import compression, transport
+from FUSE.caches import block_cache, metadata_cache, process_names
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 # handler = logging.FileHandler(f"{__name__}.log")
@@ -27,8 +30,8 @@ logger.setLevel(logging.DEBUG)
 # logger.addHandler(handler)
 
 
-def pack_q(funcname, args, kwargs, procname):
-    bytez = msgpack.packb({"funcname": funcname, "args": args, "kwargs": kwargs, "proc": procname})
+def pack_q(funcname, args, kwargs, procname, accept=()):
+    bytez = msgpack.packb({"funcname": funcname, "args": args, "kwargs": kwargs, "proc": procname, "accept": accept})
     q = base64.urlsafe_b64encode(bytez).decode("utf-8")
     return q
 
@@ -46,76 +49,172 @@ class Fuse2Rest(fuse.Operations):
         "unlink", "utimens", "write",
     )
 
-    def __init__(self, uri, assume_static=False):
+    def __init__(self, uri, assume_static=False, procname_ttl=process_names.DEFAULT_TTL, metadata=None, blocksize=block_cache.DEFAULT_IOSIZE // 4):
         self._uri = uri.rstrip("/")
         self.assume_static = assume_static
-
-        # self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # self._socket.connect(("", int(self._uri.split(":")[-1])))
-
+        self._metadata = metadata or metadata_cache.MetadataCache()
+        self._admitted = metadata_cache.Admissions(self._metadata.max_entries)  # Who the server has answered (i.e. not denied) about which path.
+
+        # Read cache, with --assume-static: blocks live in `block_cache.SHARED_POOL`.
+        self._blocksize = blocksize
+        self._buffers = {}  # path -> BlockwiseBuffer
+        self._readers = metadata_cache.Admissions(self._metadata.max_entries)  # Who the server has let read which file.
+        self._buffers_lock = threading.Lock()
+        self._reading = threading.local()  # This thread's current `(procname, fh)`, for `_read_remote`.
+        self._read_stats = block_cache.stats_for(self.__class__.__name__)
+
+        self._process_names = process_names.ProcessNames(ttl=procname_ttl)
         self._session = requests.Session()
+        self._connection = None  # Persistent, multiplexed connection, for tcp:// and unix:// URIs.
+        self._connection_lock = threading.Lock()
 
         for funcname in Fuse2Rest.FUNC_NAMES:
             setattr(self, funcname, self._wrapper(funcname))
 
     def _api(self, funcname, *args, **kwargs):
         pid = fuse.fuse_get_context()[-1]
-        proc = psutil.Process(pid)
-        procname = proc.name()
+        procname = self._process_names.name(pid)
 
         # Avoid caching data calls
         # TODO(mcotton): FUSE mount should ideally not guess what is or isn't cachable
-        if self.assume_static and funcname in {"getattr", "statfs", "readdir"}:
-            cached_call = self._call_cached
+        if self.assume_static and funcname == "read":
+            return self._read_cached(procname, *args, **kwargs)
+        elif self.assume_static and funcname == "readdir":
+            return self._readdirplus(procname, *args, **kwargs)
+        elif self.assume_static and funcname in metadata_cache.CACHED_FUNCS:
+            result = self._call_cached(procname, funcname, *args, **kwargs)
         else:
-            cached_call = self._call
+            result = self._call(procname, funcname, *args, **kwargs)
 
-        return cached_call(procname, funcname, *args, **kwargs)
+        return self._unwrap(result)
 
-    @functools.cache
     def _call_cached(self, procname, funcname, *args, **kwargs):
-        return self._call(procname, funcname, *args, **kwargs)
+        key = metadata_cache.MetadataCache.key(funcname, args, kwargs)
+        # NOTE(mcotton): The server decides who may see what (per path), so only share cached responses with processes it has let see this path before.
+        result = self._metadata.get(key) if self._admitted.admitted(procname, args[0]) else None
+        if result is None:
+            result = self._call(procname, funcname, *args, **kwargs)
+            if result["error"] not in metadata_cache.UNCACHED_ERRORS:
+                self._admitted.admit(procname, args[0])
+                self._metadata.put(key, result)
+                if funcname == "readdirplus" and result["error"] is None:
+                    self._cache_attrs(procname, args[0], result["result"])
+        return result
+
+    def _readdirplus(self, procname, path, fh):
+        """
+        `readdir`, but fetching every entry's attributes in the same round
+        trip, to serve the `getattr`s that follow from the cache.
+        """
+        dirents = self._unwrap(self._call_cached(procname, "readdirplus", path, fh))
+        return [(name, attrs, 0) for (name, attrs) in dirents]
+
+    def _read_cached(self, procname, path, length, offset, fh):
+        """
+        `read` through a local block cache, so re-reads of the same region
+        (which Music.app does a lot) don't cross the network again.
+        """
+        # NOTE(mcotton): The server decides who may read what, so a process it hasn't let read this file yet asks it directly.
+        if not self._readers.admitted(procname, path):
+            data = self._unwrap(self._call(procname, "read", path, length, offset, fh))
+            self._readers.admit(procname, path)
+            return data
+        # NOTE(mcotton): Buffers are shared by every process, so misses go to the server as whoever is reading now.
+        self._reading.call = (procname, fh)
+        return self._buffer(procname, path, fh).read(offset, length)
+
+    def _buffer(self, procname, path, fh):
+        with self._buffers_lock:
+            if path in self._buffers:
+                return self._buffers[path]
+        size = self._unwrap(self._call_cached(procname, "getattr", path, None))["st_size"]
+        with self._buffers_lock:
+            if path not in self._buffers:
+                self._buffers[path] = block_cache.BlockwiseBuffer(
+                    source=functools.partial(self._read_remote, path),
+                    size=size,
+                    key=path,
+                    pool=block_cache.SHARED_POOL,
+                    stats=self._read_stats,
+                    blocksize=self._blocksize,
+                    prefetch_blocks=0,  # NOTE(mcotton): The server already reads ahead; here, only ask for what was asked for.
+                    max_prefetch_blocks=0,
+                )
+            return self._buffers[path]
+
+    def _read_remote(self, path, length, offset):
+        (procname, fh) = self._reading.call  # No prefetching here, so it's always the reader's own thread.
+        return self._unwrap(self._call(procname, "read", path, length, offset, fh))
+
+    def _unwrap(self, result):
+        if result["error"]:
+            print(f'\t{result["error"]=}')
+            raise fuse.FuseOSError(result["error"])
+        return result["result"]
+
+    def _cache_attrs(self, procname, path, dirents):
+        for (name, attrs) in dirents:
+            if attrs is None or name in {".", ".."}:
+                continue
+            child = posixpath.join(path, name)
+            # NOTE(mcotton): fusepy calls `getattr(path, fh)`, with no `fh` outside of `fgetattr`.
+            key = metadata_cache.MetadataCache.key("getattr", [child, None], {})
+            self._metadata.put(key, {"result": attrs, "error": None})
+            self._admitted.admit(procname, child)  # It's just been shown them.
+
+    def invalidate_metadata(self, path=None):
+        """
+        Drop cached metadata for `path` (or everything), here and on the server.
+        """
+        self._metadata.invalidate(path)
+        self._admitted.invalidate(path)  # NOTE(mcotton): Who may see it may have changed, too.
+        self._readers.invalidate(path)
+        self._call("fuse2rest", "invalidate_metadata", path)
 
     def _call(self, procname, funcname, *args, **kwargs):
         t0 = time.perf_counter()
         thread_id = threading.get_ident()
         print(f"Starting {thread_id=}, {procname=}")
 
-        q = pack_q(funcname, args, kwargs, procname)
-
-        # SOCKETS = True
-        # if SOCKETS:
-        #     self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #     self._socket.connect(("", int(self._uri.split(":")[-1])))
-        #     # print("sending")
-        #     self._socket.send(q + b"\x00\x01\x00\x01\x00\x01\x00\x01")
-        #     # print("receiving")
-        #     recv = self._socket.recv(10_000_000)  # TODO: 10MB isn't a guarantee
-        #     # print("got", recv)
-        #     result = msgpack.unpackb(recv)
-        #     # print("unpacked")
-        #     self._socket.close()
-
-        HTTP = True
-        if HTTP:
-            url = self._uri + "/" + funcname
-            print(f"\t{url} ({procname})")
-
-            # data = urllib.parse.urlencode({"q": q}).encode()
-            # req = urllib.request.Request(url, data=data)
-            # result = msgpack.unpackb(urllib3.request.urlopen(req).read())
-            req = self._session.post(url, data={"q": q}, stream=True)
-            result = msgpack.unpackb(req.raw.read())
+        if transport.is_socket_uri(self._uri):
+            result = self._call_socket(procname, funcname, *args, **kwargs)
+        else:
+            result = self._call_http(procname, funcname, *args, **kwargs)
 
         t1 = time.perf_counter()
         dt = t1 - t0
         print(f"\tResolving {thread_id=} after {int(dt*1000)=}ms")
 
-        if result["error"]:
-            print(f'\t{result["error"]=}')
-            raise fuse.FuseOSError(result["error"])
-
-        return result["result"]
+        return result
+
+    def _call_http(self, procname, funcname, *args, **kwargs):
+        q = pack_q(funcname, args, kwargs, procname, compression.AVAILABLE)
+
+        url = self._uri + "/" + funcname
+        print(f"\t{url} ({procname})")
+
+        # data = urllib.parse.urlencode({"q": q}).encode()
+        # req = urllib.request.Request(url, data=data)
+        # result = msgpack.unpackb(urllib3.request.urlopen(req).read())
+        req = self._session.post(url, data={"q": q}, stream=True)
+        bytez = req.raw.read()
+        if codec := req.headers.get("X-Compression"):
+            bytez = compression.decode(codec, bytez)
+        return msgpack.unpackb(bytez)
+
+    def _call_socket(self, procname, funcname, *args, **kwargs):
+        print(f"\t{self._uri} {funcname} ({procname})")
+        for attempt in range(2):
+            with self._connection_lock:
+                if self._connection is None or self._connection.closed:
+                    self._connection = transport.Connection(self._uri)
+                connection = self._connection
+            try:
+                return connection.call(funcname, args, kwargs, procname)
+            except OSError:
+                # NOTE(mcotton): Every call is read-only, so it's safe to retry once on a fresh connection.
+                if attempt:
+                    raise
 
     def _wrapper(self, funcname):
         def f(*args, **kwargs):
@@ -126,32 +225,46 @@ class Fuse2Rest(fuse.Operations):
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("mountpoint")
-    parser.add_argument("uri")
+    parser.add_argument("uri", help="http://host:port, or tcp://host:port / unix:///path for the binary protocol")
 
     parser.add_argument("--assume-static", default=False, action="store_true",
         help="Whether to assume the underlying filesystem will never change, and to cache repsonses")
+    parser.add_argument("--iosize", default=block_cache.DEFAULT_IOSIZE, type=int,
+        help="Largest read the kernel sends at once (should match rest2passthrough --iosize)")
+    parser.add_argument("--threads", default=False, action="store_true",
+        help="Let FUSE make concurrent calls (best with a tcp:// or unix:// URI, which multiplexes them over one connection)")
+    parser.add_argument("--procname-ttl", default=process_names.DEFAULT_TTL, type=float,
+        help="Seconds to trust a cached process name before re-checking its PID wasn't reused")
+    parser.add_argument("--metadata-entries", default=metadata_cache.DEFAULT_MAX_ENTRIES, type=int,
+        help="Most getattr/readdir/statfs responses to cache, with --assume-static")
+    parser.add_argument("--metadata-ttl", default=metadata_cache.DEFAULT_TTL, type=float,
+        help="Seconds to cache a getattr/readdir/statfs response, with --assume-static")
+    parser.add_argument("--metadata-negative-ttl", default=metadata_cache.DEFAULT_NEGATIVE_TTL, type=float,
+        help="Seconds to cache an error (e.g. ENOENT) from one, with --assume-static")
+    parser.add_argument("--cache-bytes", default=block_cache.DEFAULT_POOL_BYTES, type=int,
+        help="Memory budget for blocks read, with --assume-static")
+    parser.add_argument("--blocksize", default=None, type=int,
+        help="Block size (rounded up to a power of two) of the read cache, instead of a quarter of --iosize")
 
     return parser.parse_args()
 
 
-def main():
-    args = parse_args()
-
-    volname = pathlib.Path(args.mountpoint).name
+def mount(operations, mountpoint, threads=False, iosize=block_cache.DEFAULT_IOSIZE):
+    volname = pathlib.Path(mountpoint).name
 
     import signal
     signal.signal(signal.SIGINT, signal.SIG_DFL)  # Restores CTRL+C functionality
 
     fuse.FUSE(
-        Fuse2Rest(args.uri, assume_static=args.assume_static),
-        args.mountpoint,
-        nothreads=True,  # True
+        operations,
+        mountpoint,
+        nothreads=not threads,
         foreground=True,  # `False` hangs forever and locks fuse...
         volname=volname,
 
         # macOS options
         rdonly=True,
-        iosize=2**22,  # 2**20
+        iosize=iosize,  # 2**20
         # blocksize=2**17,  # this corrupts...
 
         auto_cache=True,
@@ -172,5 +285,23 @@ def main():
     )
 
 
+def main():
+    args = parse_args()
+
+    block_cache.SHARED_POOL.resize(args.cache_bytes)
+    mount(
+        Fuse2Rest(
+            args.uri,
+            assume_static=args.assume_static,
+            procname_ttl=args.procname_ttl,
+            metadata=metadata_cache.MetadataCache(max_entries=args.metadata_entries, ttl=args.metadata_ttl, negative_ttl=args.metadata_negative_ttl),
+            blocksize=args.blocksize or (args.iosize // 4),
+        ),
+        args.mountpoint,
+        threads=args.threads,
+        iosize=args.iosize,
+    )
+
+
 if __name__ == '__main__':
     main()
@@ -1,7 +1,11 @@
 
+import collections
 import os
+import posixpath
+import threading
 
 from FUSE.backends import mmbackend, osbackend, static
+from FUSE.caches import block_cache
 from FUSE.errors import readonly, deny, notreal
 from FUSE.fuse_clients.abstract import AbstractReadOnlyFuseClient
 from FUSE.fuse_clients.passthough_client import (
@@ -53,21 +57,25 @@ ALLOW_AFTER_FINDER_HAS_READ = {
 
 
 class ReadOnlyFuseClient(AbstractReadOnlyFuseClient):
-    def __init__(self, root=None, mediaman=False, filesystem_image_mm_hash=None, filesystem_image=None, service_selector=None, hashes=None):
+    def __init__(self, root=None, mediaman=False, filesystem_image_mm_hash=None, filesystem_image=None, service_selector=None, hashes=None, disk_cache=None, iosize=block_cache.DEFAULT_IOSIZE, blocksize=None, warm_index=False, mmap=False):
+        # NOTE(mcotton): Block sizes default to the mount's `iosize`: a full block per remote round trip,
+        # but a quarter of that locally, where a miss is cheap.
         if root:
-            self.backend = osbackend.ReadOnlyOSBackend(root)
+            self.backend = osbackend.ReadOnlyOSBackend(root, blocksize=blocksize or (iosize // 4), warm=warm_index, mmap=mmap)
         elif mediaman:
-            self.backend = mmbackend.ReadOnlyFlatMMBackend(service_selector=service_selector)
+            self.backend = mmbackend.ReadOnlyFlatMMBackend(service_selector=service_selector, disk_cache=disk_cache, blocksize=blocksize or iosize)
         elif filesystem_image_mm_hash:
-            self.backend = mmbackend.ReadOnlyPredefinedMMBackend(filesystem_image_mm_hash=filesystem_image_mm_hash, service_selector=service_selector)
+            self.backend = mmbackend.ReadOnlyPredefinedMMBackend(filesystem_image_mm_hash=filesystem_image_mm_hash, service_selector=service_selector, disk_cache=disk_cache, blocksize=blocksize or iosize)
         elif filesystem_image:
-            self.backend = mmbackend.ReadOnlyPredefinedMMBackend(filesystem_image=filesystem_image, service_selector=service_selector)
+            self.backend = mmbackend.ReadOnlyPredefinedMMBackend(filesystem_image=filesystem_image, service_selector=service_selector, disk_cache=disk_cache, blocksize=blocksize or iosize)
         # elif hashes:
         #     self.backend = mmbackend.ReadOnly
         else:
             self.backend = static.StaticFlatBackend({"a.txt": b"hi", "b.txt": b"ho!", "c.txt": b"how do you do?"})
 
         self.finder_has_read = set()
+        self.open_handles = collections.Counter()  # path -> open count
+        self._handles_lock = threading.Lock()  # NOTE(mcotton): Held while releasing, too, so an `open` can't slip in as the backend lets go.
 
     def verify_procname(self, procname, path):
         if path in self.finder_has_read and procname in ALLOW_AFTER_FINDER_HAS_READ:
@@ -112,6 +120,16 @@ class ReadOnlyFuseClient(AbstractReadOnlyFuseClient):
         dirents = [".", ".."]
         return dirents + self.backend.list(path)
 
+    def readdirplus(self, path, fh):
+        """
+        Like `readdir`, but as `(name, attrs)` pairs, so listing a folder
+        doesn't cost a `getattr` round trip per entry.
+        """
+        if not self.backend.has(path):
+            notreal()
+        dirents = [(".", self.getattr(path)), ("..", None)]
+        return dirents + [(name, self.getattr(posixpath.join(path, name))) for name in self.backend.list(path)]
+
     def readlink(self, path):
         deny()
 
@@ -128,8 +146,21 @@ class ReadOnlyFuseClient(AbstractReadOnlyFuseClient):
     def open(self, path, flags):
         if not self.backend.has(path):
             notreal()
+        with self._handles_lock:
+            self.open_handles[path] += 1
         return FAKE_FILE_DESCRIPTOR
 
+    def release(self, path, fh):
+        """
+        NOTE: OS will call [open > flush > release] even to read a file.
+        """
+        print(f"release {path}")
+        with self._handles_lock:
+            self.open_handles[path] -= 1
+            if self.open_handles[path] <= 0:
+                del self.open_handles[path]
+                self.backend.release(path)
+
     def read(self, path, length, offset, fh, procname):
         """
         NOTE: OS will try to read a file created via open().
@@ -138,3 +169,13 @@ class ReadOnlyFuseClient(AbstractReadOnlyFuseClient):
         if procname == "Finder":
             self.finder_has_read.add(path)
         return self.backend.read(path, length, offset)
+
+    def read_chunks(self, path, length, offset, fh, procname):
+        """
+        Like `read`, but returns an iterator of chunks, produced as the data
+        becomes available.
+        """
+        print(path, length, offset)
+        if procname == "Finder":
+            self.finder_has_read.add(path)
+        return self.backend.read_chunks(path, length, offset)
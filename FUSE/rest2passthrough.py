@@ -3,16 +3,18 @@
 
 import argparse
 import base64
-import functools
+import concurrent.futures
 import logging
-import socket
+import threading
 
 import collections  # NOTE: Fixes issue due to old Python (3.8): `AttributeError: module 'collections' has no attribute 'Callable'`
 collections.Callable = collections.abc.Callable
 
-from flask import Flask, request
+from flask import Flask, Response, request
 import msgpack
 
+from FUSE import aio_server, compression, transport
+from FUSE.caches import block_cache, disk_cache, metadata_cache, prefetch
 from FUSE.errors import IntentionalException
 from FUSE.fuse_clients import read_only_client
 
@@ -22,6 +24,7 @@ httplib2shim.patch()
 
 
 FUSE_CLIENT = None
+METADATA_CACHE = metadata_cache.MetadataCache()
 
 app = Flask(__name__)
 
@@ -32,7 +35,15 @@ logging.getLogger("werkzeug").setLevel(logging.ERROR)
 def unpack_q(q):
     bytez = base64.urlsafe_b64decode(q.encode("utf-8"))
     data = msgpack.unpackb(bytez)
-    return (data["funcname"], data["args"], data["kwargs"], data["proc"])
+    return (data["funcname"], data["args"], data["kwargs"], data["proc"], data.get("accept", ()))
+
+
+def pack_response(funcname, out, accept):
+    """
+    Return `(body, headers)` for an HTTP response, compressed if negotiated.
+    """
+    (codec, body) = compression.encode(funcname, msgpack.packb(out), accept)
+    return (body, {"X-Compression": codec} if codec else {})
 
 
 def call(procname, funcname, *args, **kwargs):
@@ -45,92 +56,178 @@ def call(procname, funcname, *args, **kwargs):
             result = getattr(FUSE_CLIENT, funcname)(*args, **kwargs)
         return {"result": result, "error": None}
     except Exception as e:
-        if not isinstance(e, IntentionalException):
-            print(repr(e))
-        else:
-            print(f"[-] Request blocked for {procname}: {str(e)}")
-        return {"result": None, "error": e.args[0]}
+        return error_response(procname, e)
 
 
-# TODO(mcotton): Clear this cache on `refresh`, once that concept exists.
-@functools.cache
-def call_cached(procname, funcname, *args, **kwargs):
-    print(f"Caching: {procname=}, {funcname=}, {args=}, {kwargs=}")
-    # NOTE(mcotton): You can't cache exceptions!  So we have to return them as data.
-    # NOTE(mcotton): This might be a terrible idea, if we legit have a temporary issue.
-    return call(procname, funcname, *args, **kwargs)
+def call_read_chunks(procname, *args, **kwargs):
+    """
+    Like `call(procname, "read", ...)`, but the result is an iterator of
+    chunks, produced as each block lands.
+    """
+    global FUSE_CLIENT
+    try:
+        FUSE_CLIENT.verify_procname(procname, args[0])
+        return {"result": FUSE_CLIENT.read_chunks(*args, procname, **kwargs), "error": None}
+    except Exception as e:
+        return error_response(procname, e)
 
 
-@app.route('/<funcname>', methods=["POST"])
-def callback(funcname):
+def error_response(procname, e):
+    if not isinstance(e, IntentionalException):
+        print(repr(e))
+    else:
+        print(f"[-] Request blocked for {procname}: {str(e)}")
+    return {"result": None, "error": e.args[0]}
+
+
+def call_cached(procname, funcname, *args, **kwargs):
     global FUSE_CLIENT
+    # NOTE(mcotton): Permissions depend on the process, so check them before going to the (shared) cache.
+    try:
+        FUSE_CLIENT.verify_procname(procname, args[0])
+    except Exception as e:
+        return error_response(procname, e)
+    return METADATA_CACHE.call(funcname, args, kwargs, lambda: call(procname, funcname, *args, **kwargs))
 
-    (_funcname, args, kwargs, procname) = unpack_q(request.form["q"])
 
-    if funcname in {"getattr", "statfs", "readdir"}:
-        cached_call = lambda: call_cached(procname, funcname, *args, **kwargs)
-    else:
-        print(f"Fresh: {procname=}, {funcname=}, {args=}, {kwargs=}")
-        cached_call = lambda: call(procname, funcname, *args, **kwargs)
+def invalidate_metadata(path=None):
+    print(f"[i] Invalidating cached metadata for {path or 'everything'}")
+    METADATA_CACHE.invalidate(path)
+    return {"result": None, "error": None}
 
-    out = cached_call()
-    return msgpack.packb(out)
 
+def dispatch(funcname, args, kwargs, procname):
+    if funcname == "invalidate_metadata":
+        return invalidate_metadata(*args, **kwargs)
+    if funcname in metadata_cache.CACHED_FUNCS:
+        return call_cached(procname, funcname, *args, **kwargs)
+    print(f"Fresh: {procname=}, {funcname=}, {args=}, {kwargs=}")
+    return call(procname, funcname, *args, **kwargs)
 
-def socket_loop():
-    _socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    _socket.bind(("", 4013))
-    _socket.listen()
-    while True:
-        (conn, addr) = _socket.accept()
-        with conn:
-            # print("Connected by", addr)
-            agg = b""
-            while True:
-                data = conn.recv(10_000_000)  # TODO: 10MB isn't a guarantee
-                # print("received")
-                if not data:
-                    break
-                agg += data
-                if agg.endswith(b"\x00\x01\x00\x01\x00\x01\x00\x01"):  # TODO: OOF.
-                    agg = agg[:-8]
-                    break
-
-            # print("unpacking")
-            (funcname, args, kwargs, procname) = unpack_q(agg)
-            print((procname, funcname, args[:1]))
 
+@app.route('/<funcname>', methods=["POST"])
+def callback(funcname):
+    (_funcname, args, kwargs, procname, accept) = unpack_q(request.form["q"])
+    out = dispatch(funcname, args, kwargs, procname)
+    return pack_response(funcname, out, accept)
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    return Response(block_cache.prometheus_metrics() + compression.prometheus_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def handle_http(request):
+    """
+    `aio_server` handler with the same routes as the Flask app.
+    """
+    if request.path == "/metrics":
+        if request.method != "GET":
+            raise aio_server.HTTPError(405)
+        body = block_cache.prometheus_metrics() + compression.prometheus_metrics()
+        return (200, "text/plain; version=0.0.4", body.encode("utf-8"), {})
+
+    funcname = request.path.lstrip("/")
+    if not funcname or "/" in funcname:
+        raise aio_server.HTTPError(404)
+    if request.method != "POST":
+        raise aio_server.HTTPError(405)
+    try:
+        q = request.form["q"]
+    except KeyError:
+        raise aio_server.HTTPError(400)
+    (_funcname, args, kwargs, procname, accept) = unpack_q(q)
+    out = dispatch(funcname, args, kwargs, procname)
+    (body, headers) = pack_response(funcname, out, accept)
+    return (200, "application/msgpack", body, headers)
+
+
+def serve_connection(conn, executor):
+    """
+    Serve calls from one persistent connection until the client hangs up.
+
+    Calls are handled concurrently, and each response is sent (tagged with
+    its request ID) as soon as it's ready, so one slow read doesn't hold up
+    the `getattr`s queued behind it.
+    """
+    send_lock = threading.Lock()
+
+    def respond(request_id, funcname, args, kwargs, procname, accept):
+        try:
+            if funcname == "read":
+                out = call_read_chunks(procname, *args, **kwargs)
+                if out["error"] is None:
+                    transport.send_stream(conn, request_id, out["result"], send_lock)
+                    return
+            else:
+                out = dispatch(funcname, args, kwargs, procname)
+            with send_lock:
+                transport.send_response(conn, request_id, out, funcname, accept)
+        except OSError as e:
+            print(f"[!] Couldn't respond to {funcname} ({procname}): {repr(e)}")
+
+    with conn:
+        while True:
             try:
-                result = call(procname, funcname, *args, **kwargs)
-                out = {"result": result, "error": None}
-            except Exception as e:
-                # TODO: set explicit value on custom exception object
-                print(f"{repr(e)} on {funcname} {args[:1]} ({procname})")
-                # import traceback
-                # traceback.print_exc()
-                out = {"result": None, "error": e.args[0]}
+                request = transport.recv_call(conn)
+            except (transport.ConnectionClosed, ConnectionResetError):
+                return
+            executor.submit(respond, *request)
 
-            # print("sending")
-            conn.sendall(msgpack.packb(out))
-            # print("sent")
 
+def socket_loop(uri, workers):
+    _socket = transport.listen(uri)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    print(f"Serving {uri}")
+    while True:
+        (conn, addr) = _socket.accept()
+        threading.Thread(target=serve_connection, args=(conn, executor), daemon=True).start()
 
-def parse_args():
-    parser = argparse.ArgumentParser()
+
+def add_backend_args(parser):
+    """
+    Arguments choosing and tuning the backend, shared with `fuse2local`.
+    """
     # parser.add_argument("client", choices=["passthrough", "mediaman"])
     parser.add_argument("-p", "--passthrough", default=None, help="Path to the passthrough folder")
     parser.add_argument("-m", "--mediaman", default=False, action="store_true")
     parser.add_argument("-i", "--filesystem_image_mm_hash", default=None, help="MediaMan hash of a JSON file describing a filesystem")
     parser.add_argument("-j", "--filesystem_image", default=None, help="JSON file describing a filesystem")
     parser.add_argument("-s", "--service_selector", default=None, help="Which service nickname to use")
+    parser.add_argument("--mmap", default=False, action="store_true", help="Memory-map --passthrough files, instead of reading them through the block cache")
+    parser.add_argument("--warm-index", default=False, action="store_true", help="Crawl the whole --passthrough folder in the background at startup, rather than only as it's browsed")
     # parser.add_argument("-h", "--hashes", nargs="+", type=list, help="MM hashes to load")
+    parser.add_argument("--cache-bytes", default=block_cache.DEFAULT_POOL_BYTES, type=int, help="Memory budget for cached blocks, shared by all files")
+    parser.add_argument("--iosize", default=block_cache.DEFAULT_IOSIZE, type=int, help="The `iosize` the FUSE mount uses; block sizes are derived from it")
+    parser.add_argument("--blocksize", default=None, type=int, help="Cache block size (rounded up to a power of two), overriding the --iosize default")
+    parser.add_argument("--prefetch-workers", default=prefetch.DEFAULT_WORKERS, type=int, help="Threads prefetching blocks, shared by all files")
+    parser.add_argument("--disk-cache", default=None, help="Directory to persist MediaMan blocks in, across restarts")
+    parser.add_argument("--disk-cache-bytes", default=disk_cache.DEFAULT_DISK_BYTES, type=int, help="Size cap for the --disk-cache directory")
+    parser.add_argument("--metadata-entries", default=metadata_cache.DEFAULT_MAX_ENTRIES, type=int, help="Most getattr/readdir/statfs responses to cache")
+    parser.add_argument("--metadata-ttl", default=metadata_cache.DEFAULT_TTL, type=float, help="Seconds to cache a getattr/readdir/statfs response")
+    parser.add_argument("--metadata-negative-ttl", default=metadata_cache.DEFAULT_NEGATIVE_TTL, type=float, help="Seconds to cache an error (e.g. ENOENT) from one")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    add_backend_args(parser)
+    parser.add_argument("--socket", default=None, help="Serve the binary protocol on this tcp://host:port or unix:///path URI, instead of HTTP")
+    parser.add_argument("--server", default="asyncio", choices=["asyncio", "flask"], help="HTTP server to use, when not serving --socket (`flask` is Werkzeug's development server)")
+    parser.add_argument("--port", default=4001, type=int)
+    parser.add_argument("--workers", default=aio_server.DEFAULT_WORKERS, type=int, help="Threads handling blocking calls, for the asyncio server and --socket")
+    parser.add_argument("--compress-min-bytes", default=compression.MIN_BYTES, type=int, help="Smallest metadata response to compress, for clients that accept it")
     return parser.parse_args()
 
 
-def main():
-    global FUSE_CLIENT
+def setup(args):
+    """
+    Size the shared caches and build `FUSE_CLIENT`, per `add_backend_args`.
+    """
+    global FUSE_CLIENT, METADATA_CACHE
 
-    args = parse_args()
+    block_cache.SHARED_POOL.resize(args.cache_bytes)
+    prefetch.SHARED_EXECUTOR.resize(args.prefetch_workers)
+    METADATA_CACHE = metadata_cache.MetadataCache(max_entries=args.metadata_entries, ttl=args.metadata_ttl, negative_ttl=args.metadata_negative_ttl)
 
     FUSE_CLIENT = read_only_client.ReadOnlyFuseClient(
         root=args.passthrough,
@@ -138,10 +235,26 @@ def main():
         filesystem_image_mm_hash=args.filesystem_image_mm_hash,
         filesystem_image=args.filesystem_image,
         service_selector=args.service_selector,
+        disk_cache=disk_cache.DiskBlockCache(args.disk_cache, max_bytes=args.disk_cache_bytes) if args.disk_cache else None,
+        iosize=args.iosize,
+        blocksize=args.blocksize,
+        warm_index=args.warm_index,
+        mmap=args.mmap,
     )
 
-    app.run(threaded=True, port=4001, host="0.0.0.0", debug=True)
-    # socket_loop()
+
+def main():
+    args = parse_args()
+
+    compression.MIN_BYTES = args.compress_min_bytes
+    setup(args)
+
+    if args.socket:
+        socket_loop(args.socket, args.workers)
+    elif args.server == "flask":
+        app.run(threaded=True, port=args.port, host="0.0.0.0", debug=True)
+    else:
+        aio_server.Server(handle_http, workers=args.workers).run("0.0.0.0", args.port)
 
 
 if __name__ == '__main__':
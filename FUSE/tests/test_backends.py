@@ -0,0 +1,12 @@
+from FUSE.backends import static, stub
+
+
+def test_static_backend_release_uses_default():
+    backend = static.StaticFlatBackend({"a.txt": b"hi"})
+    assert backend.read("/a.txt", 2, 0) == b"hi"
+    backend.release("/a.txt")
+    assert backend.read("/a.txt", 2, 0) == b"hi"
+
+
+def test_stub_backend_release_uses_default():
+    stub.StubBackend().release("/fake.txt")
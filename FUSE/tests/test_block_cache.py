@@ -0,0 +1,57 @@
+import contextlib
+import io
+import time
+
+from FUSE.caches import block_cache, prefetch
+
+
+def sequential_read(buffer, size, read_size):
+    with contextlib.redirect_stdout(io.StringIO()):
+        data = b"".join(buffer.read(offset, read_size) for offset in range(0, size, read_size))
+        time.sleep(0.2)  # Let any prefetches still queued land.
+    return data
+
+
+def test_private_pool_prefetches_dont_evict_each_other():
+    size = int(6.5 * 2**20)
+    blocksize = 2**16
+    data = bytes(range(256)) * (size // 256)
+    buffer = block_cache.BlockwiseBuffer(lambda offset, length: data[offset:offset + length], size, blocksize=blocksize, executor=prefetch.PrefetchExecutor(4))
+
+    assert sequential_read(buffer, size, 4096) == data
+    stats = buffer.counters.snapshot()
+    assert stats["bytes_fetched"] <= size + buffer.pattern.maximum * blocksize
+    assert stats["wasted_prefetches"] == 0
+
+
+class InlineExecutor:
+    """
+    Runs each prefetch as soon as it's queued, so which blocks get
+    prefetched (rather than read on demand) doesn't depend on timing.
+    """
+    def __init__(self):
+        self.running = False
+
+    def submit(self, priority, task):
+        self.running = True
+        try:
+            task.run()
+        finally:
+            self.running = False
+
+
+def test_sequential_read_prefetches_the_tail():
+    size = 101 * 2**16 + 1000
+    blocksize = 2**16
+    data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    executor = InlineExecutor()
+    demand_fetches = []
+
+    def source(offset, length):
+        if not executor.running:
+            demand_fetches.append(offset // blocksize)
+        return data[offset:offset + length]
+
+    buffer = block_cache.BlockwiseBuffer(source, size, blocksize=blocksize, executor=executor)
+    assert sequential_read(buffer, size, 4096) == data
+    assert demand_fetches == [0]
@@ -0,0 +1,17 @@
+from FUSE.caches import metadata_cache
+
+
+def test_admissions_are_bounded_and_invalidated():
+    admissions = metadata_cache.Admissions(max_paths=2)
+    admissions.admit("Finder", "/a")
+    admissions.admit("Finder", "/b")
+    admissions.admit("Music", "/c")
+    assert not admissions.admitted("Finder", "/a")  # Least recently used, so forgotten.
+    assert admissions.admitted("Finder", "/b")
+    assert not admissions.admitted("Music", "/b")
+
+    admissions.invalidate("/b")
+    assert not admissions.admitted("Finder", "/b")
+    assert admissions.admitted("Music", "/c")
+    admissions.invalidate()
+    assert not admissions.admitted("Music", "/c")
@@ -0,0 +1,262 @@
+"""
+A length-prefixed binary framing protocol for FUSE calls, over a persistent
+TCP or Unix domain socket.
+
+Every frame is a fixed prefix, a msgpack'd metadata dict, and a raw payload:
+
+    [meta length: u32][payload length: u32][flags: u8][meta][payload]
+
+A call's metadata is `{"id", "funcname", "args", "kwargs", "proc", "accept"}`,
+and a response's is `{"id", "result", "error"}`.  The request ID lets many calls
+be in flight on one connection at once, with responses in any order.  When a response's result is bytes (i.e.
+a `read`), it travels as the raw payload instead, flagged `RAW_RESULT`, so it
+is never msgpack'd, base64'd or copied into a bigger message.
+
+A `read` is streamed as several such frames, each flagged `MORE` except the
+last (which is empty, and carries any error), so the server only ever holds
+one chunk of it and other responses can go out in between.
+
+A large metadata response may instead be compressed with one of the codecs
+the call `accept`s: its metadata is then `{"id", "codec"}`, and the payload
+(flagged `COMPRESSED`) is the compressed response.  See `compression`.
+"""
+
+import errno
+import itertools
+import socket
+import struct
+import threading
+import urllib.parse
+
+import msgpack
+
+from FUSE import compression
+
+PREFIX = struct.Struct(">IIB")
+RAW_RESULT = 0x01
+MORE = 0x02  # More frames of this (raw) result follow.
+COMPRESSED = 0x04
+
+CHUNK_SIZE = 2**18  # Largest frame of a streamed result.
+
+SMALL_PAYLOAD = 2**16  # Below this, send prefix, meta and payload in one go.
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+def parse_uri(uri):
+    """
+    Return `(family, address)` for a `tcp://host:port` or `unix:///path` URI.
+    """
+    parsed = urllib.parse.urlparse(uri)
+    if parsed.scheme == "tcp":
+        return (socket.AF_INET, (parsed.hostname or "", parsed.port))
+    elif parsed.scheme == "unix":
+        return (socket.AF_UNIX, parsed.path)
+    raise ValueError(f"Unsupported socket URI: {uri}")
+
+
+def is_socket_uri(uri):
+    return urllib.parse.urlparse(uri).scheme in {"tcp", "unix"}
+
+
+def connect(uri):
+    (family, address) = parse_uri(uri)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def listen(uri):
+    (family, address) = parse_uri(uri)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen()
+    return sock
+
+
+def recv_exactly(sock, length):
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    have = 0
+    while have < length:
+        received = sock.recv_into(view[have:])
+        if not received:
+            raise ConnectionClosed(f"Connection closed after {have}/{length} bytes")
+        have += received
+    return buffer
+
+
+def send_frame(sock, meta, payload=b"", flags=0):
+    if not isinstance(meta, bytes):
+        meta = msgpack.packb(meta)
+    prefix = PREFIX.pack(len(meta), len(payload), flags)
+    if len(payload) < SMALL_PAYLOAD:
+        sock.sendall(b"".join((prefix, meta, payload)))
+    else:
+        sock.sendall(prefix + meta)
+        sock.sendall(payload)
+
+
+def recv_frame(sock):
+    """
+    Return `(meta, payload, flags)` for the next frame on the socket.
+    """
+    (meta_length, payload_length, flags) = PREFIX.unpack(recv_exactly(sock, PREFIX.size))
+    meta = msgpack.unpackb(recv_exactly(sock, meta_length))
+    payload = recv_exactly(sock, payload_length) if payload_length else b""
+    return (meta, payload, flags)
+
+
+def send_call(sock, request_id, funcname, args, kwargs, procname, accept=()):
+    send_frame(sock, {"id": request_id, "funcname": funcname, "args": args, "kwargs": kwargs, "proc": procname, "accept": accept})
+
+
+def recv_call(sock):
+    (meta, _, _) = recv_frame(sock)
+    return (meta["id"], meta["funcname"], meta["args"], meta["kwargs"], meta["proc"], meta.get("accept", ()))
+
+
+def send_response(sock, request_id, out, funcname=None, accept=()):
+    result = out["result"]
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        send_frame(sock, {"id": request_id, "result": None, "error": out["error"]}, result, RAW_RESULT)
+        return
+
+    packed = msgpack.packb({"id": request_id, **out})
+    (codec, compressed) = compression.encode(funcname, packed, accept)
+    if codec is None:
+        send_frame(sock, packed)
+    else:
+        send_frame(sock, {"id": request_id, "codec": codec}, compressed, COMPRESSED)
+
+
+def send_stream(sock, request_id, chunks, send_lock):
+    """
+    Send a bytes result as it's produced, at most `CHUNK_SIZE` per frame,
+    holding `send_lock` only per frame.  If producing the chunks fails
+    part-way, the last frame carries the error.
+    """
+    error = None
+    chunks = iter(chunks)
+    while True:
+        # NOTE(mcotton): Only a failure to produce a chunk (i.e. the backend's) goes to the client; a failure to send one means the socket is gone.
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        except Exception as e:
+            print(f"[!] Streamed result {request_id} failed part-way: {repr(e)}")
+            error = getattr(e, "errno", None) or (e.args[0] if e.args else errno.EIO)
+            break
+        chunk = memoryview(chunk)
+        for start in range(0, len(chunk), CHUNK_SIZE):
+            with send_lock:
+                send_frame(sock, {"id": request_id}, chunk[start:start + CHUNK_SIZE], RAW_RESULT | MORE)
+    with send_lock:
+        send_frame(sock, {"id": request_id, "result": None, "error": error}, b"", RAW_RESULT)
+
+
+def recv_response(sock):
+    """
+    Return `(request_id, meta, payload, flags)` for the next response frame.
+    """
+    (meta, payload, flags) = recv_frame(sock)
+    return (meta.pop("id"), meta, payload, flags)
+
+
+class PendingCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+        self.chunks = []  # Frames of a streamed result received so far.
+
+    def receive(self, meta, payload, flags):
+        """
+        Take one response frame; returns whether the response is complete.
+        """
+        if flags & COMPRESSED:
+            meta = msgpack.unpackb(compression.decode(meta["codec"], payload))
+            meta.pop("id", None)
+        elif flags & RAW_RESULT:
+            self.chunks.append(payload)
+            if flags & MORE:
+                return False
+            meta["result"] = b"".join(self.chunks)  # NOTE(mcotton): fusepy can only `memmove` from bytes.
+            self.chunks = []
+        self.response = meta
+        return True
+
+
+class Connection:
+    """
+    A persistent connection shared by any number of threads.
+
+    Each call is tagged with a request ID and sent as soon as it's made; a
+    reader thread hands each response (in whatever order the server sends
+    them) back to the thread waiting on it.  If the connection breaks, every
+    pending call fails with `ConnectionClosed`.
+    """
+    def __init__(self, uri, accept=compression.AVAILABLE):
+        self.sock = connect(uri)
+        self.accept = accept
+        self.closed = False
+        self._ids = itertools.count()
+        self._pending = {}  # request ID -> PendingCall
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        threading.Thread(target=self._read_loop, name=f"transport-reader {uri}", daemon=True).start()
+
+    def call(self, funcname, args, kwargs, procname):
+        request_id = next(self._ids)
+        pending = PendingCall()
+        with self._lock:
+            if self.closed:
+                raise ConnectionClosed("Connection already closed")
+            self._pending[request_id] = pending
+
+        try:
+            with self._send_lock:
+                send_call(self.sock, request_id, funcname, args, kwargs, procname, self.accept)
+        except OSError as e:
+            self.close(e)
+            raise
+
+        pending.event.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.response
+
+    def _read_loop(self):
+        try:
+            while True:
+                (request_id, meta, payload, flags) = recv_response(self.sock)
+                with self._lock:
+                    pending = self._pending.get(request_id)
+                if pending is None or not pending.receive(meta, payload, flags):
+                    continue
+                with self._lock:
+                    self._pending.pop(request_id, None)
+                pending.event.set()
+        except Exception as e:
+            # NOTE(mcotton): Not just socket errors: a frame we can't make sense of leaves the stream out of step, too.
+            self.close(e)
+
+    def close(self, error=None):
+        with self._lock:
+            self.closed = True
+            (pending, self._pending) = (self._pending, {})
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for call in pending.values():
+            call.error = ConnectionClosed(f"Connection closed: {error!r}")
+            call.event.set()